@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import importlib
+import os
+import sys
+import time
+
+# Ensure the script can find the 'pageindex' package in the current directory
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from pageindex.utils import PageStore
+
+# pageindex re-exports a page_index() function that shadows the submodule attribute
+pi = importlib.import_module('pageindex.page_index')
+
+# Benchmark for fix_incorrect_toc on a document with many mislocated headings.
+# The LLM is replaced by a stub with fixed latency so the numbers only reflect
+# how the fixer schedules its calls, not network or model speed.
+
+def build_document(num_items, pages_per_item=3):
+    texts = []
+    toc = []
+    for i in range(num_items):
+        toc.append({'title': f'Section {i}', 'physical_index': i * pages_per_item + 1})
+        texts.append(f"Section {i}\nBody text of section {i}.")
+        texts.extend([f"More text of section {i}."] * (pages_per_item - 1))
+    pages = PageStore(texts, [len(t) for t in texts])
+    # Every heading is reported one page too late
+    incorrect = [
+        {'list_index': i, 'title': item['title'], 'page_number': item['physical_index'] + 1, 'answer': 'no'}
+        for i, item in enumerate(toc)
+    ]
+    return pages, toc, incorrect
+
+def install_fake_llm(latency):
+    async def fake_llm(model=None, prompt=None, **kwargs):
+        await asyncio.sleep(latency)
+        title = prompt.split('Section Title:\n', 1)[-1].split('\n', 1)[0]
+        index = int(title.rsplit(' ', 1)[-1]) if title.rsplit(' ', 1)[-1].isdigit() else 0
+        return f'{{"physical_index": "<physical_index_{index * 3 + 1}>", "answer": "yes"}}'
+    pi.ChatGPT_API_async = fake_llm
+
+async def run_sequential(pages, toc, incorrect):
+    # One incorrect item at a time, which is what the blocking fixer amounted to
+    for item in incorrect:
+        await pi.fix_incorrect_toc(toc, pages, [item])
+
+async def run_concurrent(pages, toc, incorrect):
+    await pi.fix_incorrect_toc(toc, pages, incorrect)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fix_incorrect_toc")
+    parser.add_argument('--items', type=int, default=48, help="Number of mislocated headings")
+    parser.add_argument('--latency', type=float, default=0.3, help="Simulated seconds per LLM call")
+    args = parser.parse_args()
+
+    install_fake_llm(args.latency)
+
+    pages, toc, incorrect = build_document(args.items)
+    start = time.perf_counter()
+    asyncio.run(run_sequential(pages, toc, incorrect))
+    sequential = time.perf_counter() - start
+
+    pages, toc, incorrect = build_document(args.items)
+    start = time.perf_counter()
+    asyncio.run(run_concurrent(pages, toc, incorrect))
+    concurrent = time.perf_counter() - start
+
+    print(f"[INFO] {args.items} incorrect items, {args.latency:.2f}s per LLM call")
+    print(f"[INFO] one at a time : {sequential:.2f}s")
+    print(f"[INFO] concurrent    : {concurrent:.2f}s")
+    print(f"[SUCCESS] speedup: {sequential / concurrent:.1f}x")
+
+if __name__ == '__main__':
+    main()
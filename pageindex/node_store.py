@@ -0,0 +1,218 @@
+import os
+import json
+import sqlite3
+import logging
+import argparse
+from datetime import datetime
+
+from .utils import iter_nodes, page_range_text
+
+# One database holds the nodes of every indexed document; consumers query it
+# instead of loading results/*_full.json into memory.
+NODE_STORE_PATH = os.getenv("PAGEINDEX_NODE_STORE", "./results/pageindex.sqlite")
+
+NODE_FIELDS = ('node_id', 'parent_id', 'position', 'depth', 'title', 'start_index', 'end_index', 'summary')
+
+class NodeStore:
+    """
+    SQLite store of index trees. Nodes of all documents live in one table keyed by
+    (doc_id, node_id) with their parent, title, page range, summary and text.
+    Title, summary and text are indexed with FTS5 (trigram tokenizer, so CJK and
+    substring queries work); without FTS5 support, search falls back to LIKE scans.
+    """
+    def __init__(self, path=None):
+        self.path = path or NODE_STORE_PATH
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.has_fts = False
+        self._create_schema()
+
+    def _create_schema(self):
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (
+                doc_id INTEGER PRIMARY KEY,
+                doc_name TEXT UNIQUE NOT NULL,
+                page_count INTEGER,
+                indexed_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS nodes (
+                doc_id INTEGER NOT NULL REFERENCES documents(doc_id) ON DELETE CASCADE,
+                node_id TEXT NOT NULL,
+                parent_id TEXT,
+                position INTEGER,
+                depth INTEGER,
+                title TEXT,
+                start_index INTEGER,
+                end_index INTEGER,
+                summary TEXT,
+                text TEXT,
+                PRIMARY KEY (doc_id, node_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_nodes_parent ON nodes(doc_id, parent_id, position);
+        """)
+        try:
+            self.conn.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS nodes_fts USING fts5(
+                    title, summary, text, content='nodes', content_rowid='rowid', tokenize='trigram'
+                );
+                CREATE TRIGGER IF NOT EXISTS nodes_ai AFTER INSERT ON nodes BEGIN
+                    INSERT INTO nodes_fts(rowid, title, summary, text) VALUES (new.rowid, new.title, new.summary, new.text);
+                END;
+                CREATE TRIGGER IF NOT EXISTS nodes_ad AFTER DELETE ON nodes BEGIN
+                    INSERT INTO nodes_fts(nodes_fts, rowid, title, summary, text) VALUES ('delete', old.rowid, old.title, old.summary, old.text);
+                END;
+            """)
+            self.has_fts = True
+        except sqlite3.OperationalError as e:
+            logging.warning(f"FTS5 unavailable ({e}), node search falls back to LIKE scans")
+        self.conn.commit()
+
+    def write_document(self, doc_name, structure, pages=None):
+        """
+        Replaces the stored tree of doc_name. Nodes without inline text get it from
+        pages (the shared page table of page_ref results). Returns the node count.
+        """
+        if isinstance(structure, dict):
+            structure = [structure]
+        with self.conn:
+            self.conn.execute("DELETE FROM documents WHERE doc_name = ?", (doc_name,))
+            doc_id = self.conn.execute(
+                "INSERT INTO documents (doc_name, page_count, indexed_at) VALUES (?, ?, ?)",
+                (doc_name, len(pages) if pages is not None else None, datetime.now().isoformat())
+            ).lastrowid
+            rows = list(self._node_rows(doc_id, structure, pages))
+            self.conn.executemany(
+                "INSERT INTO nodes (doc_id, node_id, parent_id, position, depth, title, start_index, end_index, summary, text) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+        return len(rows)
+
+    def _node_rows(self, doc_id, structure, pages):
+        # node_id is optional in results; fall back to the pre-order position
+        ids = {id(node): node.get('node_id') or str(i).zfill(4) for i, node in enumerate(iter_nodes(structure))}
+        stack = [(node, None, position, 1) for position, node in reversed(list(enumerate(structure)))]
+        while stack:
+            node, parent_id, position, depth = stack.pop()
+            text = node.get('text')
+            if text is None and pages is not None:
+                start = int(node.get('start_index') or 1)
+                text = page_range_text(pages, start, int(node.get('end_index') or start))
+            node_id = ids[id(node)]
+            yield (doc_id, node_id, parent_id, position, depth, node.get('title'),
+                   node.get('start_index'), node.get('end_index'), node.get('summary'), text)
+            children = node.get('nodes') or []
+            stack.extend((child, node_id, i, depth + 1) for i, child in reversed(list(enumerate(children))))
+
+    def import_results(self, full_json_path):
+        """Loads an existing results/*_full.json (page_ref or inline) into the store."""
+        with open(full_json_path, 'r', encoding='utf-8-sig') as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            doc_name = data.get('doc_name') or os.path.basename(full_json_path)
+            return self.write_document(doc_name, data.get('structure', []), data.get('pages'))
+        doc_name = os.path.basename(full_json_path)
+        if doc_name.endswith("_full.json"):
+            doc_name = doc_name[:-len("_full.json")]
+        return self.write_document(doc_name, data)
+
+    def documents(self):
+        return [dict(row) for row in self.conn.execute("SELECT doc_name, page_count, indexed_at FROM documents ORDER BY doc_name")]
+
+    def get_node(self, doc_name, node_id, with_text=True):
+        columns = ", ".join(f"n.{f}" for f in NODE_FIELDS) + (", n.text" if with_text else "")
+        row = self.conn.execute(
+            f"SELECT {columns} FROM nodes n JOIN documents d USING (doc_id) WHERE d.doc_name = ? AND n.node_id = ?",
+            (doc_name, node_id)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def children(self, doc_name, parent_id=None):
+        columns = ", ".join(f"n.{f}" for f in NODE_FIELDS)
+        return [dict(row) for row in self.conn.execute(
+            f"SELECT {columns} FROM nodes n JOIN documents d USING (doc_id) "
+            f"WHERE d.doc_name = ? AND n.parent_id IS ? ORDER BY n.position",
+            (doc_name, parent_id)
+        )]
+
+    def get_tree(self, doc_name, with_text=False):
+        """Rebuilds the nested structure of one document."""
+        columns = ", ".join(f"n.{f}" for f in NODE_FIELDS) + (", n.text" if with_text else "")
+        rows = self.conn.execute(
+            f"SELECT {columns} FROM nodes n JOIN documents d USING (doc_id) WHERE d.doc_name = ? "
+            f"ORDER BY n.depth, n.position", (doc_name,)
+        ).fetchall()
+        by_id, roots = {}, []
+        for row in rows:
+            node = {k: row[k] for k in row.keys() if k not in ('parent_id', 'position', 'depth')}
+            node['nodes'] = []
+            by_id[row['node_id']] = node
+            parent = by_id.get(row['parent_id'])
+            (parent['nodes'] if parent else roots).append(node)
+        return roots
+
+    def search(self, query, doc_name=None, limit=20):
+        """
+        Keyword search over title, summary and text of every stored document, best
+        matches first. Returns node fields plus doc_name and a text snippet.
+        """
+        query = (query or "").strip()
+        if not query: return []
+        columns = ", ".join(f"n.{f}" for f in NODE_FIELDS)
+        doc_filter = "AND d.doc_name = ?" if doc_name else ""
+        # The trigram tokenizer cannot match terms shorter than three characters
+        if self.has_fts and all(len(term) >= 3 for term in query.split()):
+            fts_query = " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+            sql = (f"SELECT d.doc_name, {columns}, snippet(nodes_fts, 2, '[', ']', '…', 16) AS snippet "
+                   f"FROM nodes_fts JOIN nodes n ON n.rowid = nodes_fts.rowid JOIN documents d USING (doc_id) "
+                   f"WHERE nodes_fts MATCH ? {doc_filter} ORDER BY bm25(nodes_fts, 10.0, 3.0, 1.0) LIMIT ?")
+            params = [fts_query] + ([doc_name] if doc_name else []) + [limit]
+        else:
+            terms = query.split()
+            where = " AND ".join("(n.title LIKE ? OR n.summary LIKE ? OR n.text LIKE ?)" for _ in terms)
+            sql = (f"SELECT d.doc_name, {columns}, substr(n.text, 1, 120) AS snippet "
+                   f"FROM nodes n JOIN documents d USING (doc_id) WHERE {where} {doc_filter} "
+                   f"ORDER BY d.doc_name, n.depth, n.position LIMIT ?")
+            params = [f"%{t}%" for t in terms for _ in range(3)] + ([doc_name] if doc_name else []) + [limit]
+        return [dict(row) for row in self.conn.execute(sql, params)]
+
+    def close(self):
+        self.conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Query or fill the PageIndex SQLite node store")
+    parser.add_argument('--db', type=str, default=None, help="Database path (default: PAGEINDEX_NODE_STORE)")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_import = sub.add_parser('import', help="Load results/*_full.json files")
+    p_import.add_argument('paths', nargs='+')
+    p_search = sub.add_parser('search', help="Full-text search across documents")
+    p_search.add_argument('query')
+    p_search.add_argument('--doc', type=str, default=None)
+    p_search.add_argument('--limit', type=int, default=20)
+    p_node = sub.add_parser('node', help="Print one node")
+    p_node.add_argument('doc')
+    p_node.add_argument('node_id')
+    sub.add_parser('docs', help="List stored documents")
+    args = parser.parse_args()
+
+    store = NodeStore(args.db)
+    try:
+        if args.command == 'import':
+            for path in args.paths:
+                print(f"[INFO] {path}: {store.import_results(path)} nodes")
+        elif args.command == 'search':
+            for hit in store.search(args.query, doc_name=args.doc, limit=args.limit):
+                print(f"{hit['doc_name']} #{hit['node_id']} p.{hit['start_index']}-{hit['end_index']} {hit['title']}")
+                print(f"    {' '.join((hit['snippet'] or '').split())}")
+        elif args.command == 'node':
+            print(json.dumps(store.get_node(args.doc, args.node_id), ensure_ascii=False, indent=2))
+        else:
+            for doc in store.documents():
+                print(f"{doc['doc_name']}\t{doc['page_count']}\t{doc['indexed_at']}")
+    finally:
+        store.close()
+
+if __name__ == '__main__':
+    main()
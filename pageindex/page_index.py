@@ -12,7 +12,21 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 from .utils import (
     ChatGPT_API,
     ChatGPT_API_async,
+    close_async_client,
+    get_llm_scheduler,
+    get_llm_cache,
+    get_request_coalescer,
+    StageTimer,
+    Checkpoint,
+    index_options,
+    page_hashes,
+    unchanged_page_map,
+    collect_summaries,
+    reuse_summaries,
+    iter_nodes,
+    write_json_stream,
     ChatGPT_API_with_finish_reason,
+    ChatGPT_API_with_finish_reason_async,
     add_node_text,
     generate_summaries_for_structure,
     add_preface_if_needed,
@@ -29,6 +43,10 @@ from .utils import (
     get_pdf_name,
     convert_physical_index_to_int,
     get_json_content,
+    local_title_check,
+    normalize_for_match,
+    tagged_page_text,
+    get_tagged_pages,
     config
 )
 
@@ -53,6 +71,10 @@ async def check_title_appearance(item, page_list, start_index=1, model=None):
 
     page_text = page_list[list_idx][0]
 
+    local_answer = local_title_check(title, page_text)
+    if local_answer is not None:
+        return {'list_index': item.get('list_index'), 'answer': local_answer, 'title': title, 'page_number': page_number, 'source': 'local'}
+
     prompt = f"""
     Your job is to check if the given section appears or starts in the given page_text.
 
@@ -74,10 +96,107 @@ async def check_title_appearance(item, page_list, start_index=1, model=None):
         answer = response['answer']
     else:
         answer = 'no'
-    return {'list_index': item.get('list_index'), 'answer': answer, 'title': title, 'page_number': page_number}
+    return {'list_index': item.get('list_index'), 'answer': answer, 'title': title, 'page_number': page_number, 'source': 'llm'}
 #####################################################
 
+async def check_title_appearance_batch(items, page_list, start_index=1, model=None, batch_size=20, max_tokens=20000):
+    """
+    Batched variant of check_title_appearance: packs many (title, page) checks into one prompt.
+    Clear matches and misses are settled by local_title_check first. Items that land on the same physical page are grouped so each page's text is sent only once.
+    Checks missing from a batch answer fall back to check_title_appearance.
+    """
+    results = [None] * len(items)
+    pages = {}
+    for pos, item in enumerate(items):
+        try:
+            page_number = int(item['physical_index'])
+        except (KeyError, ValueError, TypeError):
+            results[pos] = {'list_index': item.get('list_index'), 'answer': 'no', 'title': item.get('title'), 'page_number': None}
+            continue
+        list_idx = page_number - start_index
+        if list_idx < 0 or list_idx >= len(page_list):
+            results[pos] = {'list_index': item.get('list_index'), 'answer': 'no', 'title': item.get('title'), 'page_number': page_number}
+            continue
+        local_answer = local_title_check(item['title'], page_list[list_idx][0])
+        if local_answer is not None:
+            results[pos] = {'list_index': item.get('list_index'), 'answer': local_answer, 'title': item['title'], 'page_number': page_number, 'source': 'local'}
+            continue
+        pages.setdefault(page_number, []).append(pos)
+
+    # Pack whole pages into batches bounded by item count and page-text tokens
+    batches = []
+    current, current_items, current_tokens = [], 0, 0
+    for page_number in sorted(pages):
+        page_tokens = page_list[page_number - start_index][1]
+        if current and (current_items + len(pages[page_number]) > batch_size or current_tokens + page_tokens > max_tokens):
+            batches.append(current)
+            current, current_items, current_tokens = [], 0, 0
+        current.append(page_number)
+        current_items += len(pages[page_number])
+        current_tokens += page_tokens
+    if current:
+        batches.append(current)
+
+    async def check_batch(batch_pages):
+        checks = []
+        page_text = ""
+        for page_number in batch_pages:
+            for pos in pages[page_number]:
+                checks.append({'id': pos, 'title': items[pos]['title'], 'physical_index': page_number})
+            page_text += tagged_page_text(page_list, page_number - start_index, page_number)
+
+        prompt = f"""
+    Your job is to check, for each given check, if the section title appears or starts in the page_text of the page given by its physical_index.
+
+    Note: do fuzzy matching, ignore any space inconsistency in the page_text.
+
+    The provided pages contains tags like <physical_index_X> and <physical_index_X> to indicate the start and end of page X.
+
+    The given checks are {json.dumps(checks, ensure_ascii=False)}.
+    The given pages are:
+    {page_text}
+
+    Reply format:
+    [
+        {{
+            "id": <id of the check>,
+            "answer": "yes or no" (yes if the section appears or starts in the page_text of its physical_index, no otherwise)
+        }},
+        ...
+    ]
+    Return one entry for every check. Directly return the final JSON structure. Do not output anything else."""
+
+        response = await ChatGPT_API_async(model=model, prompt=prompt)
+        response = extract_json(response)
+        answers = {}
+        if isinstance(response, list):
+            for entry in response:
+                if isinstance(entry, dict) and 'id' in entry and 'answer' in entry:
+                    try:
+                        answers[int(entry['id'])] = entry['answer']
+                    except (ValueError, TypeError):
+                        continue
+        for check in checks:
+            pos = check['id']
+            if pos in answers:
+                results[pos] = {'list_index': items[pos].get('list_index'), 'answer': answers[pos], 'title': check['title'], 'page_number': check['physical_index'], 'source': 'llm'}
+
+    await asyncio.gather(*[check_batch(batch_pages) for batch_pages in batches])
+
+    missing = [pos for pos, result in enumerate(results) if result is None]
+    if missing:
+        fallback = await asyncio.gather(*[check_title_appearance(items[pos], page_list, start_index, model) for pos in missing])
+        for pos, result in zip(missing, fallback):
+            results[pos] = result
+    return results
+
 async def check_title_appearance_in_start(title, page_text, model=None, logger=None):    
+    local_answer = local_title_check(title, page_text, at_start=True)
+    if local_answer is not None:
+        if logger:
+            logger.info({'title_start_check': title, 'start_begin': local_answer, 'source': 'local'})
+        return local_answer
+
     prompt = f"""
     You will be given the current section title and the current page_text.
     Your job is to check if the current section starts in the beginning of the given page_text.
@@ -99,7 +218,7 @@ async def check_title_appearance_in_start(title, page_text, model=None, logger=N
     response = await ChatGPT_API_async(model=model, prompt=prompt)
     response = extract_json(response)
     if logger:
-        logger.info(f"Response: {response}")
+        logger.info({'title_start_check': title, 'start_begin': response.get("start_begin", "no"), 'source': 'llm', 'response': response})
     return response.get("start_begin", "no")
 
 
@@ -133,8 +252,8 @@ async def check_title_appearance_in_start_concurrent(structure, page_list, model
     return structure
 
 
-def toc_detector_single_page(content, model=None):
-    prompt = f"""
+def toc_detector_prompt(content):
+    return f"""
     Your job is to detect if there is a table of content provided in the given text.
 
     Given text: {content}
@@ -148,7 +267,56 @@ def toc_detector_single_page(content, model=None):
     Directly return the final JSON structure. Do not output anything else.
     Please note: abstract,summary, notation list, figure list, table list, etc. are not table of contents."""
 
-    response = ChatGPT_API(model=model, prompt=prompt)
+DOT_LEADER_PATTERNS = [r'\.{5,}', r'(?:\. ){5,}\.?']
+
+def transform_dots_to_colon(text):
+    for pattern in DOT_LEADER_PATTERNS:
+        text = re.sub(pattern, ': ', text)
+    return text
+
+TOC_KEYWORD_RE = re.compile(r'table of contents|^\s*contents\s*$|目\s*录|目\s*次', re.IGNORECASE | re.MULTILINE)
+NOT_TOC_KEYWORD_RE = re.compile(r'list of (?:figures|tables|illustrations)|图\s*目\s*录|表\s*目\s*录|插图目录', re.IGNORECASE)
+DOT_LEADER_RE = re.compile('|'.join(DOT_LEADER_PATTERNS + [r'…{2,}', r'·{5,}']))
+TRAILING_PAGE_NUMBER_RE = re.compile(r'(?:^|[\s.·…:])(?:\d{1,4}|[ivxlcdm]{1,7})$', re.IGNORECASE)
+
+def toc_page_heuristic(content):
+    """
+    Local TOC classifier built on line-ending page numbers, dot-leader density and the
+    line-length distribution. Returns 'yes' or 'no' for obvious pages and None for
+    borderline pages, which are left to the LLM.
+    """
+    lines = [line.strip() for line in (content or '').splitlines() if line.strip()]
+    if sum(len(line) for line in lines) < 20:
+        return 'no'
+    # Figure/table lists look like TOCs but are not, let the model decide
+    if NOT_TOC_KEYWORD_RE.search(content):
+        return None
+
+    numbered_ratio = sum(1 for line in lines if TRAILING_PAGE_NUMBER_RE.search(line)) / len(lines)
+    dot_leader_ratio = sum(1 for line in lines if DOT_LEADER_RE.search(line)) / len(lines)
+    lengths = sorted(len(line) for line in lines)
+    median_length = lengths[len(lengths) // 2]
+    has_keyword = bool(TOC_KEYWORD_RE.search(content))
+
+    if len(lines) >= 5 and numbered_ratio >= 0.4 and (dot_leader_ratio >= 0.3 or (has_keyword and numbered_ratio >= 0.5)):
+        return 'yes'
+    if not has_keyword and dot_leader_ratio == 0 and numbered_ratio < 0.1 and median_length >= 50:
+        return 'no'
+    return None
+
+def toc_detector_single_page(content, model=None):
+    local_result = toc_page_heuristic(content)
+    if local_result is not None:
+        return local_result
+    response = ChatGPT_API(model=model, prompt=toc_detector_prompt(content))
+    json_content = extract_json(response)    
+    return json_content.get('toc_detected', 'no')
+
+async def toc_detector_single_page_async(content, model=None):
+    local_result = toc_page_heuristic(content)
+    if local_result is not None:
+        return local_result
+    response = await ChatGPT_API_async(model=model, prompt=toc_detector_prompt(content))
     json_content = extract_json(response)    
     return json_content.get('toc_detected', 'no')
 
@@ -247,11 +415,6 @@ def detect_page_index(toc_content, model=None):
     return json_content.get('page_index_given_in_toc', 'no')
 
 def toc_extractor(page_list, toc_page_list, model):
-    def transform_dots_to_colon(text):
-        text = re.sub(r'\.{5,}', ': ', text)
-        text = re.sub(r'(?:\. ){5,}\.?', ': ', text)
-        return text
-    
     toc_content = ""
     for page_index in toc_page_list:
         toc_content += page_list[page_index][0]
@@ -358,25 +521,48 @@ def toc_transformer(toc_content, model=None):
     except:
         return []
 
-def find_toc_pages(start_page_index, page_list, opt, logger=None):
+async def find_toc_pages(start_page_index, page_list, opt, logger=None):
     print('start find_toc_pages')
-    last_page_is_yes = False
+    # All candidate pages up to toc_check_page_num are classified concurrently, then the
+    # contiguous-TOC rule is applied in page order. Requests for pages after the end of
+    # the TOC run are cancelled as soon as that end is known.
+    window_end = min(max(opt.toc_check_page_num, start_page_index), len(page_list))
+    tasks = {
+        i: asyncio.ensure_future(toc_detector_single_page_async(page_list[i][0], model=opt.model))
+        for i in range(start_page_index, window_end)
+    }
     toc_page_list = []
-    i = start_page_index
-    
-    while i < len(page_list):
-        if i >= opt.toc_check_page_num and not last_page_is_yes:
-            break
-        detected_result = toc_detector_single_page(page_list[i][0],model=opt.model)
-        if detected_result == 'yes':
-            if logger:
-                logger.info(f'Page {i} has toc')
-            toc_page_list.append(i)
-            last_page_is_yes = True
-        elif detected_result == 'no' and last_page_is_yes:
+    run_ended = False
+    try:
+        for i in range(start_page_index, window_end):
+            detected_result = await tasks[i]
+            if detected_result == 'yes':
+                if logger:
+                    logger.info(f'Page {i} has toc')
+                toc_page_list.append(i)
+            elif toc_page_list:
+                if logger:
+                    logger.info(f'Found the last page with toc: {i-1}')
+                run_ended = True
+                break
+    finally:
+        pending = [task for task in tasks.values() if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    # A TOC that is still running at the end of the window continues page by page
+    i = window_end
+    while toc_page_list and not run_ended and i < len(page_list):
+        detected_result = await toc_detector_single_page_async(page_list[i][0], model=opt.model)
+        if detected_result != 'yes':
             if logger:
                 logger.info(f'Found the last page with toc: {i-1}')
             break
+        if logger:
+            logger.info(f'Page {i} has toc')
+        toc_page_list.append(i)
         i += 1
     
     if not toc_page_list and logger:
@@ -476,7 +662,7 @@ def page_list_to_group_text(page_contents, token_lengths, max_tokens=20000, over
     print('divide page_list to groups', len(subsets))
     return subsets
 
-def add_page_number_to_toc(part, structure, model=None):
+def page_number_prompt(part, structure_json):
     fill_prompt_seq = """
     You are given an JSON structure of a document and a partial part of the document. Your task is to check if the title that is described in the structure is started in the partial given document.
 
@@ -499,7 +685,10 @@ def add_page_number_to_toc(part, structure, model=None):
     The given structure contains the result of the previous part, you need to fill the result of the current part, do not change the previous result.
     Directly return the final JSON structure. Do not output anything else."""
 
-    prompt = fill_prompt_seq + f"\n\nCurrent Partial Document:\n{part}\n\nGiven Structure\n{json.dumps(structure, indent=2)}\n"
+    return fill_prompt_seq + f"\n\nCurrent Partial Document:\n{part}\n\nGiven Structure\n{structure_json}\n"
+
+def add_page_number_to_toc(part, structure, model=None):
+    prompt = page_number_prompt(part, json.dumps(structure, indent=2))
     current_json_raw = ChatGPT_API(model=model, prompt=prompt)
     json_result = extract_json(current_json_raw)
     
@@ -510,6 +699,43 @@ def add_page_number_to_toc(part, structure, model=None):
         return json_result
     return structure
 
+async def add_page_number_to_toc_async(part, structure, model=None, structure_json=None):
+    # structure_json lets concurrent callers serialize a shared structure only once
+    prompt = page_number_prompt(part, structure_json or json.dumps(structure, ensure_ascii=False))
+    current_json_raw = await ChatGPT_API_async(model=model, prompt=prompt)
+    json_result = extract_json(current_json_raw)
+    
+    if isinstance(json_result, list):
+        json_result = [item for item in json_result if isinstance(item, dict)]
+        for item in json_result:
+            item.pop('start', None)
+        return json_result
+    return structure
+
+def merge_page_number_results(toc_items, group_results):
+    """
+    Fills the missing physical_index of toc_items from per-group answers. Groups are
+    taken in document order, so the first group that places a section wins.
+    """
+    for result in group_results:
+        if not isinstance(result, list):
+            continue
+        by_key = {}
+        for found in result:
+            by_key.setdefault((str(found.get('structure')), normalize_for_match(found.get('title'))), found)
+            by_key.setdefault(normalize_for_match(found.get('title')), found)
+        for i, item in enumerate(toc_items):
+            if item.get('physical_index') is not None:
+                continue
+            title_key = normalize_for_match(item.get('title'))
+            if i < len(result) and normalize_for_match(result[i].get('title')) == title_key:
+                found = result[i]
+            else:
+                found = by_key.get((str(item.get('structure')), title_key)) or by_key.get(title_key)
+            if found and re.search(r'\d', str(found.get('physical_index') or '')):
+                item['physical_index'] = found['physical_index']
+    return toc_items
+
 def remove_first_physical_index_section(text):
     pattern = r'<physical_index_\d+>.*?<physical_index_\d+>'
     match = re.search(pattern, text, re.DOTALL)
@@ -551,8 +777,7 @@ def generate_toc_continue(toc_content, part, model="gpt-4o-2024-11-20"):
     else:
         raise Exception(f'finish reason: {finish_reason}')
     
-def generate_toc_init(part, model=None):
-    print('start generate_toc_init')
+def toc_init_prompt(part):
     prompt = """
     You are an expert in extracting hierarchical tree structure, your task is to generate the tree structure of the document.
 
@@ -577,7 +802,11 @@ def generate_toc_init(part, model=None):
 
     Directly return the final JSON structure. Do not output anything else."""
 
-    prompt = prompt + '\nGiven text\n:' + part
+    return prompt + '\nGiven text\n:' + part
+
+def generate_toc_init(part, model=None):
+    print('start generate_toc_init')
+    prompt = toc_init_prompt(part)
     response, finish_reason = ChatGPT_API_with_finish_reason(model=model, prompt=prompt)
 
     if finish_reason == 'finished':
@@ -585,13 +814,104 @@ def generate_toc_init(part, model=None):
     else:
         raise Exception(f'finish reason: {finish_reason}')
 
+async def generate_toc_init_async(part, model=None):
+    prompt = toc_init_prompt(part)
+    response, finish_reason = await ChatGPT_API_with_finish_reason_async(model=model, prompt=prompt)
+
+    if finish_reason == 'finished':
+         return extract_json(response)
+    else:
+        raise Exception(f'finish reason: {finish_reason}')
+
+def merge_group_tocs(group_tocs):
+    """
+    Deterministic merge of independently generated group TOCs: drops headings repeated
+    on the overlapping pages and shifts each group's top-level numbering so structure
+    indices keep increasing across group boundaries.
+    """
+    merged = []
+    seen = set()
+    top_offset = 0
+    for group_toc in group_tocs:
+        group_toc = convert_physical_index_to_int([dict(item) for item in group_toc if isinstance(item, dict) and item.get('title')])
+        group_top = 0
+        for item in group_toc:
+            key = (normalize_for_match(item['title']), item.get('physical_index'))
+            parts = str(item.get('structure') or '').split('.')
+            try:
+                top = int(parts[0])
+            except ValueError:
+                top = None
+            if key in seen:
+                continue
+            seen.add(key)
+            if top is not None:
+                group_top = max(group_top, top)
+                item['structure'] = '.'.join([str(top + top_offset)] + parts[1:])
+            merged.append(item)
+        top_offset += group_top
+    return merged
+
+async def reconcile_toc(toc_items, model=None, logger=None):
+    prompt = """
+    You are an expert in extracting hierarchical tree structure.
+    You are given the headings of a document, extracted independently from consecutive parts of the document and concatenated in reading order.
+    Because each part was processed on its own, the hierarchy and the structure numbering may be inconsistent across part boundaries, and a heading may appear twice.
+
+    Your task is to return the corrected list of headings for the whole document:
+    - fix the hierarchy so that subsections are nested under the right section across part boundaries
+    - renumber the structure index consistently for the whole document
+    - remove duplicated headings
+    - keep the title and the physical_index of every heading unchanged, and keep the reading order
+
+    The structure variable is the numeric system which represents the index of the hierarchy section in the table of contents. For example, the first section has structure index 1, the first subsection has structure index 1.1, the second subsection has structure index 1.2, etc.
+
+    The response should be in the following format. 
+        [
+            {
+                "structure": <structure index, "x.x.x"> (string),
+                "title": <title of the section, keep the original title>,
+                "physical_index": <physical_index of the section, keep the given value>
+            },
+            ...
+        ]
+    Directly return the final JSON structure. Do not output anything else."""
+
+    prompt = prompt + '\nGiven headings\n:' + json.dumps(toc_items, ensure_ascii=False)
+    response, finish_reason = await ChatGPT_API_with_finish_reason_async(model=model, prompt=prompt)
+    reconciled = extract_json(response) if finish_reason == 'finished' else []
+    if not isinstance(reconciled, list):
+        reconciled = []
+    reconciled = convert_physical_index_to_int([item for item in reconciled if isinstance(item, dict) and item.get('title')])
+
+    # Keep the reconciled hierarchy only if it did not lose headings or page positions
+    if len(reconciled) >= len(toc_items) * 0.9 and all(item.get('physical_index') is not None for item in reconciled):
+        return reconciled
+    if logger: logger.info('reconcile_toc rejected, keeping merged group TOCs')
+    return toc_items
+
+async def process_no_toc_parallel(page_list, start_index=1, model=None, logger=None):
+    """
+    Map-reduce variant of process_no_toc: headings of every page group are extracted
+    concurrently, then merged and reconciled in one pass instead of chaining
+    generate_toc_continue calls group after group.
+    """
+    page_contents, token_lengths = get_tagged_pages(page_list, start_index, model)
+    group_texts = page_list_to_group_text(page_contents, token_lengths)
+    if logger: logger.info(f'len(group_texts): {len(group_texts)}')
+
+    group_tocs = await asyncio.gather(*[generate_toc_init_async(group_text, model) for group_text in group_texts])
+    toc_with_page_number = merge_group_tocs(group_tocs)
+    if logger: logger.info(f'merge_group_tocs: {toc_with_page_number}')
+
+    if len(group_texts) > 1 and toc_with_page_number:
+        toc_with_page_number = await reconcile_toc(toc_with_page_number, model=model, logger=logger)
+    if logger: logger.info(f'generate_toc: {toc_with_page_number}')
+
+    return toc_with_page_number
+
 def process_no_toc(page_list, start_index=1, model=None, logger=None):
-    page_contents=[]
-    token_lengths=[]
-    for page_index in range(start_index, start_index+len(page_list)):
-        page_text = f"<physical_index_{page_index}>\n{page_list[page_index-start_index][0]}\n<physical_index_{page_index}>\n\n"
-        page_contents.append(page_text)
-        token_lengths.append(count_tokens(page_text, model))
+    page_contents, token_lengths = get_tagged_pages(page_list, start_index, model)
     group_texts = page_list_to_group_text(page_contents, token_lengths)
     if logger: logger.info(f'len(group_texts): {len(group_texts)}')
 
@@ -606,22 +926,26 @@ def process_no_toc(page_list, start_index=1, model=None, logger=None):
 
     return toc_with_page_number
 
-def process_toc_no_page_numbers(toc_content, toc_page_list, page_list,  start_index=1, model=None, logger=None):
-    page_contents=[]
-    token_lengths=[]
+async def process_toc_no_page_numbers(toc_content, toc_page_list, page_list,  start_index=1, model=None, logger=None):
     toc_content = toc_transformer(toc_content, model)
     if logger: logger.info(f'toc_transformer: {toc_content}')
-    for page_index in range(start_index, start_index+len(page_list)):
-        page_text = f"<physical_index_{page_index}>\n{page_list[page_index-start_index][0]}\n<physical_index_{page_index}>\n\n"
-        page_contents.append(page_text)
-        token_lengths.append(count_tokens(page_text, model))
+    page_contents, token_lengths = get_tagged_pages(page_list, start_index, model)
     
     group_texts = page_list_to_group_text(page_contents, token_lengths)
     if logger: logger.info(f'len(group_texts): {len(group_texts)}')
 
     toc_with_page_number=copy.deepcopy(toc_content)
-    for group_text in group_texts:
-        toc_with_page_number = add_page_number_to_toc(group_text, toc_with_page_number, model)
+    # Every group is scanned concurrently against the entries still missing a physical_index;
+    # the slim structure is serialized once and shared by all group prompts
+    pending = [item for item in toc_with_page_number if item.get('physical_index') is None]
+    if pending:
+        pending_structure = [{'structure': item.get('structure'), 'title': item.get('title')} for item in pending]
+        structure_json = json.dumps(pending_structure, ensure_ascii=False)
+        group_results = await asyncio.gather(*[
+            add_page_number_to_toc_async(group_text, pending_structure, model, structure_json=structure_json)
+            for group_text in group_texts
+        ])
+        merge_page_number_results(pending, group_results)
     if logger: logger.info(f'add_page_number_to_toc: {toc_with_page_number}')
 
     toc_with_page_number = convert_physical_index_to_int(toc_with_page_number)
@@ -631,7 +955,7 @@ def process_toc_no_page_numbers(toc_content, toc_page_list, page_list,  start_in
 
 
 
-def process_toc_with_page_numbers(toc_content, toc_page_list, page_list, toc_check_page_num=None, model=None, logger=None):
+async def process_toc_with_page_numbers(toc_content, toc_page_list, page_list, toc_check_page_num=None, model=None, logger=None):
     toc_with_page_number = toc_transformer(toc_content, model)
     if logger: logger.info(f'toc_with_page_number: {toc_with_page_number}')
 
@@ -641,7 +965,7 @@ def process_toc_with_page_numbers(toc_content, toc_page_list, page_list, toc_che
     main_content = ""
     for page_index in range(start_page_index, min(start_page_index + toc_check_page_num, len(page_list))):
         if page_index < len(page_list):
-            main_content += f"<physical_index_{page_index+1}>\n{page_list[page_index][0]}\n<physical_index_{page_index+1}>\n\n"
+            main_content += tagged_page_text(page_list, page_index, page_index+1)
 
     toc_with_physical_index = toc_index_extractor(toc_no_page_number, main_content, model)
     if logger: logger.info(f'toc_with_physical_index: {toc_with_physical_index}')
@@ -658,7 +982,7 @@ def process_toc_with_page_numbers(toc_content, toc_page_list, page_list, toc_che
     toc_with_page_number = add_page_offset_to_toc_json(toc_with_page_number, offset)
     if logger: logger.info(f'toc_with_page_number: {toc_with_page_number}')
 
-    toc_with_page_number = process_none_page_numbers(toc_with_page_number, page_list, model=model)
+    toc_with_page_number = await process_none_page_numbers(toc_with_page_number, page_list, model=model)
     if logger: logger.info(f'toc_with_page_number: {toc_with_page_number}')
 
     return toc_with_page_number
@@ -666,9 +990,12 @@ def process_toc_with_page_numbers(toc_content, toc_page_list, page_list, toc_che
 
 
 ##check if needed to process none page numbers
-def process_none_page_numbers(toc_items, page_list, start_index=1, model=None):
+async def process_none_page_numbers(toc_items, page_list, start_index=1, model=None):
+    # Group the unresolved items by their (previous, next) known page window so that
+    # items sharing a window are resolved by one request; windows run concurrently.
+    windows = {}
     for i, item in enumerate(toc_items):
-        if "physical_index" not in item:
+        if item.get('physical_index') is None:
             # Find previous physical_index
             prev_physical_index = 0
             for j in range(i - 1, -1, -1):
@@ -683,30 +1010,31 @@ def process_none_page_numbers(toc_items, page_list, start_index=1, model=None):
                     next_physical_index = toc_items[j]['physical_index']
                     break
 
-            page_contents = []
-            for page_index in range(prev_physical_index, next_physical_index+1):
-                list_index = page_index - start_index
-                if list_index >= 0 and list_index < len(page_list):
-                    page_text = f"<physical_index_{page_index}>\n{page_list[list_index][0]}\n<physical_index_{page_index}>\n\n"
-                    page_contents.append(page_text)
-                else:
-                    continue
-
-            item_copy = copy.deepcopy(item)
-            if 'page' in item_copy: del item_copy['page']
-            
-            result = add_page_number_to_toc(page_contents, item_copy, model)
-            if result and isinstance(result, list):
-                res_item = result[0]
-                if isinstance(res_item.get('physical_index'), str) and res_item['physical_index'].startswith('<physical_index'):
-                    item['physical_index'] = int(res_item['physical_index'].split('_')[-1].rstrip('>').strip())
-                    if 'page' in item: del item['page']
-    
+            windows.setdefault((prev_physical_index, next_physical_index), []).append(item)
+
+    async def resolve_window(window, items):
+        prev_physical_index, next_physical_index = window
+        page_contents = []
+        for page_index in range(prev_physical_index, next_physical_index+1):
+            list_index = page_index - start_index
+            if list_index >= 0 and list_index < len(page_list):
+                page_contents.append(tagged_page_text(page_list, list_index, page_index))
+
+        item_copies = [{k: v for k, v in item.items() if k != 'page'} for item in items]
+        result = await add_page_number_to_toc_async(''.join(page_contents), item_copies, model)
+        merge_page_number_results(item_copies, [result])
+        for item, item_copy in zip(items, item_copies):
+            physical_index = item_copy.get('physical_index')
+            if isinstance(physical_index, str) and physical_index.startswith('<physical_index'):
+                item['physical_index'] = int(physical_index.split('_')[-1].rstrip('>').strip())
+                if 'page' in item: del item['page']
+
+    await asyncio.gather(*[resolve_window(window, items) for window, items in windows.items()])
     return toc_items
 
 
-def check_toc(page_list, opt=None):
-    toc_page_list = find_toc_pages(start_page_index=0, page_list=page_list, opt=opt)
+async def check_toc(page_list, opt=None):
+    toc_page_list = await find_toc_pages(start_page_index=0, page_list=page_list, opt=opt)
     if len(toc_page_list) == 0:
         print('no toc found')
         return {'toc_content': None, 'toc_page_list': [], 'page_index_given_in_toc': 'no'}
@@ -724,7 +1052,7 @@ def check_toc(page_list, opt=None):
                    current_start_index < len(page_list) and 
                    current_start_index < opt.toc_check_page_num):
                 
-                additional_toc_pages = find_toc_pages(
+                additional_toc_pages = await find_toc_pages(
                     start_page_index=current_start_index,
                     page_list=page_list,
                     opt=opt
@@ -745,7 +1073,7 @@ def check_toc(page_list, opt=None):
 
 
 ################### fix incorrect toc #########################################################
-def single_toc_item_index_fixer(section_title, content, model="gpt-4o-2024-11-20"):
+def index_fixer_prompt(section_title, content):
     tob_extractor_prompt = """
     You are given a section title and several pages of a document, your job is to find the physical index of the start page of the section in the partial document.
 
@@ -758,11 +1086,20 @@ def single_toc_item_index_fixer(section_title, content, model="gpt-4o-2024-11-20
     }
     Directly return the final JSON structure. Do not output anything else."""
 
-    prompt = tob_extractor_prompt + '\nSection Title:\n' + str(section_title) + '\nDocument pages:\n' + content
+    return tob_extractor_prompt + '\nSection Title:\n' + str(section_title) + '\nDocument pages:\n' + content
+
+def single_toc_item_index_fixer(section_title, content, model="gpt-4o-2024-11-20"):
+    prompt = index_fixer_prompt(section_title, content)
     response = ChatGPT_API(model=model, prompt=prompt)
     json_content = extract_json(response)    
     return convert_physical_index_to_int([json_content])[0].get('physical_index')
 
+async def single_toc_item_index_fixer_async(section_title, content, model="gpt-4o-2024-11-20"):
+    prompt = index_fixer_prompt(section_title, content)
+    response = await ChatGPT_API_async(model=model, prompt=prompt)
+    json_content = extract_json(response)    
+    return convert_physical_index_to_int([json_content])[0].get('physical_index')
+
 
 
 async def fix_incorrect_toc(toc_with_page_number, page_list, incorrect_results, start_index=1, model=None, logger=None):
@@ -805,13 +1142,12 @@ async def fix_incorrect_toc(toc_with_page_number, page_list, incorrect_results,
             for page_index in range(prev_correct, next_correct+1):
                 list_index_local = page_index - start_index
                 if list_index_local >= 0 and list_index_local < len(page_list):
-                    page_text = f"<physical_index_{page_index}>\n{page_list[list_index_local][0]}\n<physical_index_{page_index}>\n\n"
-                    page_contents.append(page_text)
+                    page_contents.append(tagged_page_text(page_list, list_index_local, page_index))
                 else:
                     continue
             content_range = ''.join(page_contents)
             
-            physical_index_int = single_toc_item_index_fixer(incorrect_item['title'], content_range, model)
+            physical_index_int = await single_toc_item_index_fixer_async(incorrect_item['title'], content_range, model)
             
             if physical_index_int is None:
                 return None
@@ -876,7 +1212,7 @@ async def fix_incorrect_toc_with_retries(toc_with_page_number, page_list, incorr
 
 
 ################### verify toc #########################################################
-async def verify_toc(page_list, list_result, start_index=1, N=None, model=None):
+async def verify_toc(page_list, list_result, start_index=1, N=None, model=None, batch_size=None, logger=None):
     print('start verify_toc')
     # Find the last non-None physical_index
     last_physical_index = None
@@ -905,12 +1241,21 @@ async def verify_toc(page_list, list_result, start_index=1, N=None, model=None):
             item_with_index['list_index'] = idx
             indexed_sample_list.append(item_with_index)
 
-    tasks = [
-        check_title_appearance(item, page_list, start_index, model)
-        for item in indexed_sample_list
-    ]
-    results = await asyncio.gather(*tasks)
+    if batch_size and batch_size > 1:
+        results = await check_title_appearance_batch(indexed_sample_list, page_list, start_index, model, batch_size=batch_size)
+    else:
+        tasks = [
+            check_title_appearance(item, page_list, start_index, model)
+            for item in indexed_sample_list
+        ]
+        results = await asyncio.gather(*tasks)
     
+    if logger:
+        logger.info({'verify_toc_decisions': [
+            {'title': r['title'], 'page_number': r['page_number'], 'answer': r['answer'], 'source': r.get('source')}
+            for r in results
+        ]})
+
     correct_count = 0
     incorrect_results = []
     for result in results:
@@ -931,9 +1276,11 @@ async def meta_processor(page_list, mode=None, toc_content=None, toc_page_list=N
     print(f'start_index: {start_index}')
     
     if mode == 'process_toc_with_page_numbers':
-        toc_with_page_number = process_toc_with_page_numbers(toc_content, toc_page_list, page_list, toc_check_page_num=opt.toc_check_page_num, model=opt.model, logger=logger)
+        toc_with_page_number = await process_toc_with_page_numbers(toc_content, toc_page_list, page_list, toc_check_page_num=opt.toc_check_page_num, model=opt.model, logger=logger)
     elif mode == 'process_toc_no_page_numbers':
-        toc_with_page_number = process_toc_no_page_numbers(toc_content, toc_page_list, page_list, model=opt.model, logger=logger)
+        toc_with_page_number = await process_toc_no_page_numbers(toc_content, toc_page_list, page_list, model=opt.model, logger=logger)
+    elif getattr(opt, 'toc_generation_mode', 'sequential') == 'parallel':
+        toc_with_page_number = await process_no_toc_parallel(page_list, start_index=start_index, model=opt.model, logger=logger)
     else:
         toc_with_page_number = process_no_toc(page_list, start_index=start_index, model=opt.model, logger=logger)
             
@@ -946,7 +1293,7 @@ async def meta_processor(page_list, mode=None, toc_content=None, toc_page_list=N
         logger=logger
     )
     
-    accuracy, incorrect_results = await verify_toc(page_list, toc_with_page_number, start_index=start_index, model=opt.model)
+    accuracy, incorrect_results = await verify_toc(page_list, toc_with_page_number, start_index=start_index, model=opt.model, batch_size=getattr(opt, 'verify_batch_size', None), logger=logger)
         
     if logger:
         logger.info({
@@ -1001,11 +1348,19 @@ async def process_large_node_recursively(node, page_list, opt=None, logger=None)
     
     return node
 
-async def tree_parser(page_list, opt, doc=None, logger=None):
-    check_toc_result = check_toc(page_list, opt)
+async def tree_parser(page_list, opt, doc=None, logger=None, checkpoint=None):
+    checkpoint = checkpoint or Checkpoint()
+    check_toc_result = checkpoint.load('check_toc')
+    if check_toc_result is None:
+        check_toc_result = await check_toc(page_list, opt)
+        checkpoint.save('check_toc', check_toc_result)
     if logger: logger.info(check_toc_result)
 
-    if check_toc_result.get("toc_content") and check_toc_result["toc_content"].strip() and check_toc_result["page_index_given_in_toc"] == "yes":
+    toc_with_page_number = checkpoint.load('meta_processor')
+    resumed = toc_with_page_number is not None
+    if resumed:
+        print('Resuming from meta_processor checkpoint')
+    elif check_toc_result.get("toc_content") and check_toc_result["toc_content"].strip() and check_toc_result["page_index_given_in_toc"] == "yes":
         toc_with_page_number = await meta_processor(
             page_list, 
             mode='process_toc_with_page_numbers', 
@@ -1021,6 +1376,8 @@ async def tree_parser(page_list, opt, doc=None, logger=None):
             start_index=1, 
             opt=opt,
             logger=logger)
+    if not resumed:
+        checkpoint.save('meta_processor', toc_with_page_number)
 
     toc_with_page_number = add_preface_if_needed(toc_with_page_number)
     toc_with_page_number = await check_title_appearance_in_start_concurrent(toc_with_page_number, page_list, model=opt.model, logger=logger)
@@ -1037,6 +1394,143 @@ async def tree_parser(page_list, opt, doc=None, logger=None):
     return toc_tree
 
 
+# Below this share of unchanged pages a revision is indexed from scratch
+INCREMENTAL_MIN_UNCHANGED = 0.5
+
+def load_previous_index(doc, opt=None):
+    """
+    Earlier results of this document with the page hashes they were built from, or
+    None when there are none or they were built with different options.
+    """
+    full_path = getattr(opt, 'previous_index', None) or os.path.join("results", f"{get_pdf_name(doc)}_full.json")
+    if not full_path.endswith("_full.json"):
+        return None
+    hashes_path = full_path[:-len("_full.json")] + "_pages.json"
+    if not (os.path.isfile(full_path) and os.path.isfile(hashes_path)):
+        return None
+    try:
+        with open(hashes_path, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+        if saved.get('options') != index_options(opt):
+            print(f"[INFO] Previous index {full_path} was built with other options, indexing from scratch")
+            return None
+        old_hashes = saved['page_hashes']
+        with open(full_path, 'r', encoding='utf-8') as f:
+            structure = json.load(f)
+        if isinstance(structure, dict):
+            structure = structure['structure']
+    except (OSError, ValueError, KeyError) as e:
+        print(f"[WARN] Ignoring previous index {full_path}: {e}")
+        return None
+    return {
+        'structure': structure,
+        'page_hashes': old_hashes,
+        # Collected up front, the old tree is reshaped in place when grafting
+        'summaries': collect_summaries(structure, old_hashes)
+    }
+
+def locate_moved_title(title, page_list, candidate_pages):
+    """First changed page (1-based) that starts with the title, checked locally only."""
+    for page in candidate_pages:
+        if local_title_check(title, page_list[page-1][0], at_start=True) == 'yes':
+            return page
+    return None
+
+def place_previous_nodes(old_nodes, page_list, page_map, changed_pages, first_page, last_page, dropped):
+    """
+    Places sibling nodes of the previous tree in the revised document, within pages
+    [first_page, last_page]. Returns (nodes, changed): nodes whose pages are all
+    unchanged come back with shifted page numbers; the others are rebuilt with their
+    children placed the same way and listed in changed.
+    """
+    placed = []
+    last_start = first_page
+    for j, node in enumerate(old_nodes):
+        start = page_map.get(node['start_index'])
+        if start is None:
+            candidates = [p for p in changed_pages if last_start <= p <= last_page]
+            start = locate_moved_title(node['title'], page_list, candidates)
+        if start is None or start < last_start or start > last_page:
+            # Its pages fold into the preceding section, which is then reprocessed
+            dropped.append(node['title'])
+            continue
+        # A parent's own end_index stops at its first child, so the old span of the
+        # whole subtree runs to the next old sibling (or its deepest end_index)
+        if j < len(old_nodes) - 1:
+            old_end = max(old_nodes[j+1]['start_index'], node['start_index'])
+        else:
+            old_end = max(n['end_index'] for n in iter_nodes(node))
+        placed.append((node, start, old_end))
+        last_start = start
+
+    nodes, changed = [], []
+    for i, (node, start, old_end) in enumerate(placed):
+        end = max(placed[i+1][1], start) if i < len(placed) - 1 else last_page
+        offset = start - node['start_index']
+        unchanged = (end - start == old_end - node['start_index']
+                     and all(page_map.get(p) == p + offset for p in range(node['start_index'], old_end + 1)))
+        if unchanged:
+            for n in iter_nodes(node):
+                n['start_index'] += offset
+                n['end_index'] += offset
+                n.pop('text', None)
+                n.pop('summary', None)
+            nodes.append(node)
+        else:
+            children, _ = place_previous_nodes(node.get('nodes') or [], page_list, page_map, changed_pages, start, end, dropped)
+            fresh = {'title': node['title'], 'start_index': start, 'end_index': end, 'nodes': children}
+            if children:
+                # The section's own text stops where its first subsection begins
+                fresh['end_index'] = children[0]['start_index']
+            nodes.append(fresh)
+            changed.append(fresh)
+    return nodes, changed
+
+async def reuse_previous_tree(previous, page_list, new_hashes, opt, logger=None):
+    """
+    Rebuilds the tree of a revised document from its previous index.
+    Sections whose pages are all unchanged are grafted with shifted page numbers;
+    changed ones keep the placement of their headings but go back through
+    process_large_node_recursively. Returns None when too little of the document
+    survived for this to beat a fresh run.
+    """
+    old_hashes = previous['page_hashes']
+    page_map = unchanged_page_map(old_hashes, new_hashes)
+    if not new_hashes or len(page_map) < INCREMENTAL_MIN_UNCHANGED * len(new_hashes):
+        return None
+
+    mapped_pages = set(page_map.values())
+    changed_pages = [p for p in range(1, len(new_hashes) + 1) if p not in mapped_pages]
+    dropped = []
+    toc_tree, changed = place_previous_nodes(previous['structure'], page_list, page_map, changed_pages,
+                                             1, len(page_list), dropped)
+    if not toc_tree:
+        return None
+    if old_hashes == new_hashes and (changed or dropped):
+        # Every page is unchanged, so every section should have been grafted as is
+        print(f"[WARN] Unchanged revision still reprocesses {[node['title'] for node in changed]}, dropped {dropped}")
+    if toc_tree[0]['start_index'] > 1:
+        toc_tree.insert(0, {'title': 'Preface / Abstract', 'start_index': 1, 'end_index': toc_tree[0]['start_index'], 'nodes': []})
+        changed.insert(0, toc_tree[0])
+
+    await asyncio.gather(*[
+        process_large_node_recursively(node, page_list, opt, logger=logger)
+        for node in changed
+    ])
+
+    if logger:
+        logger.info({'incremental_reindex': {
+            'unchanged_pages': len(page_map),
+            'total_pages': len(new_hashes),
+            'grafted_sections': len(toc_tree) - len(changed),
+            'reprocessed_sections': [node['title'] for node in changed],
+            'dropped_sections': dropped
+        }})
+    print(f"Incremental re-index: {len(page_map)}/{len(new_hashes)} pages unchanged, "
+          f"{len(changed)} of {len(toc_tree)} top-level sections reprocessed")
+    return toc_tree
+
+
 def page_index_main(doc, opt=None):
     logger = JsonLogger(doc)
     
@@ -1047,38 +1541,104 @@ def page_index_main(doc, opt=None):
     if not is_valid_pdf:
         raise ValueError("Unsupported input type. Expected a PDF file path or BytesIO object.")
 
-    print('Parsing PDF...')
-    page_list = get_page_tokens(doc)
+    get_request_coalescer().reset()
+
+    timer = StageTimer()
+    checkpoint = Checkpoint(doc, opt) if getattr(opt, 'if_use_checkpoint', 'yes') == 'yes' else Checkpoint()
+    page_list = checkpoint.load_page_list()
+    if page_list is not None:
+        print(f'Resuming from checkpoint: {checkpoint.dir}')
+    else:
+        print('Parsing PDF...')
+        with timer.stage('parse_pdf'):
+            page_list = get_page_tokens(doc, model=opt.model)
+        checkpoint.save_page_list(page_list)
+    hashes = page_hashes(page_list)
+    previous = load_previous_index(doc, opt) if getattr(opt, 'if_reuse_previous_index', 'yes') == 'yes' else None
 
     logger.info({'total_page_number': len(page_list)})
     logger.info({'total_token': sum([page[1] for page in page_list])})
 
-    async def page_index_builder():
-        structure = await tree_parser(page_list, opt, doc=doc, logger=logger)
-        if opt.if_add_node_id == 'yes':
-            write_node_id(structure)    
-        if opt.if_add_node_text == 'yes':
-            add_node_text(structure, page_list)
-        if opt.if_add_node_summary == 'yes':
-            if opt.if_add_node_text == 'no':
+    # Text is only saved when node text or summaries were asked for. page_ref: nodes
+    # keep only their page range and _full.json carries one shared page table;
+    # inline: every node stores its own copy of the page text
+    with_text = opt.if_add_node_text == 'yes' or opt.if_add_node_summary == 'yes'
+    inline_text = getattr(opt, 'node_text_format', 'page_ref') == 'inline'
+
+    async def build_structure():
+        try:
+            structure = checkpoint.load('tree')
+            if structure is None:
+                with timer.stage('tree_parser'):
+                    if previous:
+                        structure = await reuse_previous_tree(previous, page_list, hashes, opt, logger=logger)
+                    if structure is None:
+                        structure = await tree_parser(page_list, opt, doc=doc, logger=logger, checkpoint=checkpoint)
+                if opt.if_add_node_id == 'yes':
+                    write_node_id(structure)    
+                checkpoint.save('tree', structure)
+            if inline_text and with_text:
                 add_node_text(structure, page_list)
-            await generate_summaries_for_structure(structure, model=opt.model)
+            if opt.if_add_node_summary == 'yes':
+                if previous:
+                    reused = reuse_summaries(structure, hashes, previous['summaries'])
+                    logger.info({'reused_summaries': reused})
+                with timer.stage('summaries'):
+                    await generate_summaries_for_structure(structure, model=opt.model, checkpoint=checkpoint, page_list=page_list)
+            return structure
+        finally:
+            # 释放连接池，aiohttp 会话不能跨 event loop 复用
+            await close_async_client()
+            logger.info({'llm_scheduler': get_llm_scheduler().stats})
+            logger.info({'llm_cache': get_llm_cache().stats()})
+            logger.info({'llm_dedup': get_request_coalescer().stats})
+
+    async def page_index_builder():
+        structure = await build_structure()
 
         # --- 1. 先把包含完整正文的数据保存到硬盘 (Full Version) ---
         
-        # 深度拷贝一份，防止瘦身操作影响到我们要保存的文件
-        full_structure = copy.deepcopy(structure)
-        
         # 自动获取文件名（例如 aidishengtest_full.json）
         pdf_name = get_pdf_name(doc)
+
+        if inline_text or not with_text:
+            # 先落盘再瘦身，直接写原结构，无需再拷贝一份；未要求正文时不写页表
+            full_structure = structure
+        else:
+            # 正文按页只存一份，节点通过 start_index/end_index 引用
+            full_structure = {
+                'doc_name': pdf_name,
+                'node_text_format': 'page_ref',
+                'pages': [text for text, _ in page_list],
+                'structure': structure
+            }
         full_save_path = os.path.join("results", f"{pdf_name}_full.json")
         
         # 确保目录存在
         os.makedirs("results", exist_ok=True)
         
         # 保存完整版
-        with open(full_save_path, 'w', encoding='utf-8') as f:
-            json.dump(full_structure, f, ensure_ascii=False, indent=2)
+        with timer.stage('save_results'):
+            with open(full_save_path, 'w', encoding='utf-8') as f:
+                write_json_stream(full_structure, f, compact=getattr(opt, 'if_compact_json', 'no') == 'yes')
+            # 页面哈希及建树选项，供文档修订后增量重建索引（选项不同则不复用）
+            with open(os.path.join("results", f"{pdf_name}_pages.json"), 'w', encoding='utf-8') as f:
+                json.dump({'page_hashes': hashes, 'options': index_options(opt)}, f)
+        # 结果已落盘，检查点不再需要；留着会让下次运行直接重放旧结果
+        checkpoint.remove()
+
+        # 可选：写入 SQLite 节点库（含 FTS5 全文索引），供跨文档检索
+        if getattr(opt, 'if_write_node_store', 'no') == 'yes':
+            # 延迟导入：package 导入时不加载，python -m pageindex.node_store 也不会重复导入
+            from .node_store import NodeStore
+            with timer.stage('node_store'):
+                store = NodeStore(getattr(opt, 'node_store_path', None))
+                try:
+                    node_count = store.write_document(pdf_name, structure, pages=None if inline_text else page_list)
+                finally:
+                    store.close()
+            print(f"[SUCCESS] {node_count} 个节点已写入节点库: {os.path.abspath(store.path)}")
+        logger.info({'stage_timings': timer.timings})
         
         # 在控制台打印一条绿色提示，告诉你文件在哪
         print(f"\n[SUCCESS] 完整召回数据已存至: {os.path.abspath(full_save_path)}")
@@ -1090,7 +1650,11 @@ def page_index_main(doc, opt=None):
         # 返回瘦身后的结构，这样 pgui.py 的控制台就不会因为打印万字长文而崩溃了
         return structure  
 
-    return asyncio.run(page_index_builder())
+    try:
+        return asyncio.run(page_index_builder())
+    finally:
+        logger.close()
+        logger.compact()
 
 
 def page_index(doc, model=None, toc_check_page_num=None, max_page_num_each_node=None, max_token_num_each_node=None,
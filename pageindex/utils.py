@@ -3,13 +3,24 @@ import re
 import ssl
 import json
 import time
-import copy
+import atexit
+import hashlib
+import difflib
+import sqlite3
+import unicodedata
+import math
 import asyncio
 import logging
+import functools
+import threading
+import contextlib
+import aiohttp
 import requests
 import urllib3
 import yaml
+from io import BytesIO
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from types import SimpleNamespace as config
 
@@ -54,7 +65,13 @@ class UniversalFallback(dict):
     def get(self, key, default=None):
         return super().get(key, default)
 
-def request_api_stream_sync(model, messages, timeout=180):
+# --- Pooled HTTP Clients ---
+# Keep-alive connections are reused across LLM calls instead of paying a TCP/TLS
+# handshake per request. Pool size and keep-alive can be tuned via env vars.
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "32"))
+LLM_KEEPALIVE_TIMEOUT = float(os.getenv("LLM_KEEPALIVE_TIMEOUT", "60"))
+
+def _build_llm_request(model, messages):
     target_model = "DeepSeek-V3" # Ensure this model name matches your provider's requirements
     
     headers = {
@@ -70,16 +87,132 @@ def request_api_stream_sync(model, messages, timeout=180):
         "stream": True,
         "temperature": 0.1
     }
+    return headers, payload
+
+def _parse_stream_line(line):
+    """Returns the content delta of one SSE line, None to skip it, or False on [DONE]."""
+    line_str = line.decode('utf-8').strip() if isinstance(line, bytes) else line.strip()
+    if not line_str.startswith("data:"): return None
+    data_part = line_str[5:].strip()
+    if data_part == "[DONE]": return False
+    try:
+        data_json = json.loads(data_part)
+        delta = data_json['choices'][0].get('delta', {})
+    except: return None
+    if 'content' not in delta or not delta['content']: return None
+    content_str = delta['content']
+    # === 【新增功能】 实时将字符输出到 stdout 供 GUI 捕获 ===
+    # DEBUG_AI_CHAR 是 pgui.py 识别的特殊标记
+    print(f"DEBUG_AI_CHAR:{content_str}", flush=True)
+    # ===================================================
+    return content_str
+
+_sync_session = None
+
+def get_sync_session():
+    """Shared requests.Session with a keep-alive connection pool."""
+    global _sync_session
+    if _sync_session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=LLM_POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _sync_session = session
+    return _sync_session
+
+class AsyncLLMClient:
+    """
+    Native asyncio client with a keep-alive connection pool.
+    An aiohttp session is bound to the event loop that created it, so the session
+    is rebuilt transparently when called from a new loop (e.g. a second asyncio.run).
+    """
+    def __init__(self, pool_size=None, keepalive_timeout=None):
+        self.pool_size = pool_size or LLM_POOL_SIZE
+        self.keepalive_timeout = keepalive_timeout or LLM_KEEPALIVE_TIMEOUT
+        self._session = None
+        self._loop = None
+
+    def _get_session(self):
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size,
+                keepalive_timeout=self.keepalive_timeout,
+                ssl=False
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._loop = loop
+        return self._session
+
+    async def request_stream(self, model, messages, timeout=180):
+        headers, payload = _build_llm_request(model, messages)
+        session = self._get_session()
+        # Like requests' timeout: bounds connecting and each read, not the whole stream
+        client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+
+        for url in [API_ENDPOINT]:
+            try:
+                async with session.post(url, headers=headers, json=payload, timeout=client_timeout) as response:
+                    if "text/html" in response.headers.get("Content-Type", ""):
+                        logging.warning(f"⚠️ URL {url} returned HTML (Login Page). Skipping...")
+                        continue
+
+                    # 401 Handling
+                    if response.status == 401:
+                        logging.error(f"⚠️ URL {url} failed with 401 Unauthorized. Check your API KEY.")
+                        continue
+
+                    if response.status == 429:
+                        get_llm_scheduler().backoff(_retry_after_seconds(response.headers))
+                        logging.warning(f"⚠️ URL {url} rate limited (429). Backing off...")
+                        continue
+
+                    if response.status != 200:
+                        logging.warning(f"⚠️ URL {url} failed with {response.status}")
+                        continue
+
+                    full_content = ""
+                    async for line in response.content:
+                        content_str = _parse_stream_line(line)
+                        if content_str is False: break
+                        if content_str: full_content += content_str
+
+                    if full_content:
+                        return full_content
+            except Exception as e:
+                logging.error(f"Connection error to {url}: {e}")
+                continue
+
+        return "Error"
+
+    async def close(self):
+        if self._session is not None and not self._session.closed and self._loop is asyncio.get_running_loop():
+            await self._session.close()
+        self._session = None
+        self._loop = None
+
+_async_client = None
+
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncLLMClient()
+    return _async_client
+
+async def close_async_client():
+    if _async_client is not None:
+        await _async_client.close()
+
+def request_api_stream_sync(model, messages, timeout=180):
+    headers, payload = _build_llm_request(model, messages)
+    session = get_sync_session()
     
-    urls_to_try = [
-        "https://api.deepseek.com/v1/chat/completions"
-        "https://api.deepseek.com/v1/chat/completions"
-        
-    ]
+    urls_to_try = [API_ENDPOINT]
 
     for url in urls_to_try:
         try:
-            response = requests.post(
+            response = session.post(
                 url, 
                 headers=headers, 
                 json=payload, 
@@ -88,39 +221,31 @@ def request_api_stream_sync(model, messages, timeout=180):
                 stream=True 
             )
             
-            if "text/html" in response.headers.get("Content-Type", ""):
-                logging.warning(f"⚠️ URL {url} returned HTML (Login Page). Skipping...")
-                continue
-            
-            # 401 Handling
-            if response.status_code == 401:
-                logging.error(f"⚠️ URL {url} failed with 401 Unauthorized. Check your API KEY.")
-                continue
+            with response:
+                if "text/html" in response.headers.get("Content-Type", ""):
+                    logging.warning(f"⚠️ URL {url} returned HTML (Login Page). Skipping...")
+                    continue
+                
+                # 401 Handling
+                if response.status_code == 401:
+                    logging.error(f"⚠️ URL {url} failed with 401 Unauthorized. Check your API KEY.")
+                    continue
 
-            if response.status_code != 200:
-                logging.warning(f"⚠️ URL {url} failed with {response.status_code}")
-                continue
+                if response.status_code == 429:
+                    get_llm_scheduler().backoff(_retry_after_seconds(response.headers))
+                    logging.warning(f"⚠️ URL {url} rate limited (429). Backing off...")
+                    continue
 
-            full_content = ""
-            for line in response.iter_lines():
-                if not line: continue
-                line_str = line.decode('utf-8').strip()
-                if line_str.startswith("data:"):
-                    data_part = line_str[5:].strip()
-                    if data_part == "[DONE]": break
-                    try:
-                        data_json = json.loads(data_part)
-                        delta = data_json['choices'][0].get('delta', {})
-                        if 'content' in delta:
-                            content_str = delta['content']
-                            full_content += content_str
-                            
-                            # === 【新增功能】 实时将字符输出到 stdout 供 GUI 捕获 ===
-                            # DEBUG_AI_CHAR 是 pgui.py 识别的特殊标记
-                            print(f"DEBUG_AI_CHAR:{content_str}", flush=True)
-                            # ===================================================
-
-                    except: continue
+                if response.status_code != 200:
+                    logging.warning(f"⚠️ URL {url} failed with {response.status_code}")
+                    continue
+
+                full_content = ""
+                for line in response.iter_lines():
+                    if not line: continue
+                    content_str = _parse_stream_line(line)
+                    if content_str is False: break
+                    if content_str: full_content += content_str
             
             if full_content:
                 return full_content
@@ -130,6 +255,221 @@ def request_api_stream_sync(model, messages, timeout=180):
 
     return "Error"
 
+async def request_api_stream_async(model, messages, timeout=180):
+    return await get_async_client().request_stream(model, messages, timeout)
+
+# --- LLM Scheduler ---
+# One scheduler is shared by every LLM call site. It caps requests in flight and
+# spends requests-per-minute / tokens-per-minute budgets (0 disables a budget).
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_RPM = int(os.getenv("LLM_RPM", "600"))
+LLM_TPM = int(os.getenv("LLM_TPM", "1000000"))
+
+def _retry_after_seconds(headers, default=10.0):
+    try:
+        return max(1.0, float(headers.get("Retry-After", default)))
+    except (TypeError, ValueError):
+        return default
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at rate_per_minute.
+    reserve() spends tokens up front (the balance may go negative) and returns how
+    long the caller has to wait, so waiters are served in arrival order.
+    """
+    def __init__(self, rate_per_minute, burst_seconds=10):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        if self.rate <= 0: return 0.0
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def charge(self, amount):
+        """Spends tokens after the fact (e.g. completion tokens) without waiting."""
+        if self.rate <= 0 or amount <= 0: return
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= amount
+
+class LLMScheduler:
+    def __init__(self, max_concurrency=None, rpm=None, tpm=None):
+        self.max_concurrency = max_concurrency or LLM_MAX_CONCURRENCY
+        self.request_bucket = TokenBucket(LLM_RPM if rpm is None else rpm)
+        self.token_bucket = TokenBucket(LLM_TPM if tpm is None else tpm)
+        self._sync_semaphore = threading.BoundedSemaphore(self.max_concurrency)
+        self._async_semaphore = None
+        self._loop = None
+        self._paused_until = 0.0
+        self.stats = {'requests': 0, 'throttled': 0, 'wait_seconds': 0.0, 'rate_limited': 0}
+
+    def _get_async_semaphore(self):
+        # asyncio primitives are bound to one event loop, rebuild them for a new loop
+        loop = asyncio.get_running_loop()
+        if self._async_semaphore is None or self._loop is not loop:
+            self._async_semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+        return self._async_semaphore
+
+    def _reserve(self, tokens):
+        wait = max(self.request_bucket.reserve(1), self.token_bucket.reserve(tokens))
+        wait = max(wait, self._paused_until - time.monotonic())
+        self.stats['requests'] += 1
+        if wait > 0:
+            self.stats['throttled'] += 1
+            self.stats['wait_seconds'] += wait
+        return wait
+
+    def backoff(self, seconds):
+        """Pauses all new requests after the provider answered 429."""
+        self.stats['rate_limited'] += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def charge(self, tokens):
+        self.token_bucket.charge(tokens)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tokens):
+        wait = self._reserve(tokens)
+        if wait > 0: await asyncio.sleep(wait)
+        async with self._get_async_semaphore():
+            yield
+
+    @contextlib.contextmanager
+    def slot_sync(self, tokens):
+        wait = self._reserve(tokens)
+        if wait > 0: time.sleep(wait)
+        with self._sync_semaphore:
+            yield
+
+_llm_scheduler = None
+
+def get_llm_scheduler():
+    global _llm_scheduler
+    if _llm_scheduler is None:
+        _llm_scheduler = LLMScheduler()
+    return _llm_scheduler
+
+def configure_llm_scheduler(max_concurrency=None, rpm=None, tpm=None):
+    global _llm_scheduler
+    _llm_scheduler = LLMScheduler(max_concurrency, rpm, tpm)
+    return _llm_scheduler
+
+def _messages_tokens(messages):
+    return sum(count_tokens(m.get('content') or '') for m in messages)
+
+# --- LLM Response Cache ---
+# Persistent, content-addressed cache of successful completions. Entries are keyed
+# by the model, messages and temperature actually sent, and the least recently
+# used entries are evicted once the cache grows past LLM_CACHE_MAX_MB.
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "./cache")
+LLM_CACHE_MAX_MB = float(os.getenv("LLM_CACHE_MAX_MB", "512"))
+LLM_CACHE_BYPASS = os.getenv("LLM_CACHE_BYPASS", "0").lower() in ("1", "yes", "true")
+
+class LLMResponseCache:
+    def __init__(self, cache_dir=None, max_bytes=None, bypass=None):
+        self.path = os.path.join(cache_dir or LLM_CACHE_DIR, "llm_cache.sqlite")
+        self.max_bytes = int(max_bytes if max_bytes is not None else LLM_CACHE_MAX_MB * 1024 * 1024)
+        self.bypass = LLM_CACHE_BYPASS if bypass is None else bypass
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self._conn = None
+        self._total_bytes = 0
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_access REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON entries(last_access)")
+            self._conn.commit()
+            self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        return self._conn
+
+    @staticmethod
+    def make_key(model, messages):
+        _, payload = _build_llm_request(model, messages)
+        raw = json.dumps(
+            {'model': payload['model'], 'messages': payload['messages'], 'temperature': payload['temperature']},
+            sort_keys=True, ensure_ascii=False
+        )
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if self.bypass: return None
+        with self.lock:
+            try:
+                conn = self._connect()
+                row = conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+                conn.commit()
+                self.hits += 1
+                return row[0]
+            except sqlite3.Error as e:
+                logging.warning(f"LLM cache read failed: {e}")
+                return None
+
+    def put(self, key, value):
+        if self.bypass: return
+        size = len(value.encode('utf-8'))
+        with self.lock:
+            try:
+                conn = self._connect()
+                old = conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                    (key, value, size, time.time())
+                )
+                self._total_bytes += size - (old[0] if old else 0)
+                if self._total_bytes > self.max_bytes:
+                    self._evict(conn)
+                conn.commit()
+            except sqlite3.Error as e:
+                logging.warning(f"LLM cache write failed: {e}")
+
+    def _evict(self, conn):
+        # Drop least recently used entries until the cache is back under 90% of its budget
+        target = self.max_bytes * 0.9
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_access").fetchall():
+            if self._total_bytes <= target: break
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._total_bytes -= size
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0,
+            'size_bytes': self._total_bytes,
+            'bypass': self.bypass
+        }
+
+_llm_cache = None
+
+def get_llm_cache():
+    global _llm_cache
+    if _llm_cache is None:
+        _llm_cache = LLMResponseCache()
+    return _llm_cache
+
 # --- Framework Adapters ---
 
 def clean_deepseek_content(content):
@@ -140,10 +480,20 @@ def clean_deepseek_content(content):
 
 def ChatGPT_API_with_finish_reason(model, prompt, api_key=None, chat_history=None):
     messages = chat_history + [{"role": "user", "content": prompt}] if chat_history else [{"role": "user", "content": prompt}]
+    cache = get_llm_cache()
+    cache_key = cache.make_key(model, messages)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached, "finished"
+    scheduler = get_llm_scheduler()
     for i in range(3):
-        raw = request_api_stream_sync(model, messages)
+        with scheduler.slot_sync(_messages_tokens(messages)):
+            raw = request_api_stream_sync(model, messages)
+        scheduler.charge(count_tokens(raw))
         if raw != "Error" and raw.strip():
-            return clean_deepseek_content(raw), "finished"
+            content = clean_deepseek_content(raw)
+            cache.put(cache_key, content)
+            return content, "finished"
         print(f'************* API Retry ({i+1}) *************')
         time.sleep(3)
     return "Error", "failed"
@@ -152,9 +502,90 @@ def ChatGPT_API(model, prompt, api_key=None, chat_history=None):
     res, _ = ChatGPT_API_with_finish_reason(model, prompt, api_key, chat_history)
     return res
 
-async def ChatGPT_API_async(model, prompt, api_key=None):
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, ChatGPT_API, model, prompt)
+class RequestCoalescer:
+    """
+    Lets concurrent identical prompts share one outstanding API call.
+    The shared call runs as its own task so a cancelled waiter does not cancel it
+    for the others; it is only cancelled once every waiter has gone away.
+    """
+    def __init__(self):
+        self._inflight = {}
+        self._loop = None
+        self.reset()
+
+    def reset(self):
+        self.stats = {'requests': 0, 'coalesced': 0}
+
+    def _get_inflight(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._inflight = {}
+            self._loop = loop
+        return self._inflight
+
+    async def run(self, key, coro_factory):
+        inflight = self._get_inflight()
+        self.stats['requests'] += 1
+        entry = inflight.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(coro_factory())
+            entry = inflight[key] = {'task': task, 'waiters': 0}
+            task.add_done_callback(lambda _, entry=entry: self._forget(inflight, key, entry))
+        else:
+            self.stats['coalesced'] += 1
+        entry['waiters'] += 1
+        try:
+            return await asyncio.shield(entry['task'])
+        finally:
+            entry['waiters'] -= 1
+            if entry['waiters'] == 0 and not entry['task'].done():
+                # Forget it right away: the task may still be awaiting cleanup, and a
+                # new caller with the same key must start a fresh call, not join this one
+                self._forget(inflight, key, entry)
+                entry['task'].cancel()
+
+    @staticmethod
+    def _forget(inflight, key, entry):
+        # A later call with the same key may already own the slot
+        if inflight.get(key) is entry:
+            del inflight[key]
+
+_request_coalescer = None
+
+def get_request_coalescer():
+    global _request_coalescer
+    if _request_coalescer is None:
+        _request_coalescer = RequestCoalescer()
+    return _request_coalescer
+
+async def _request_with_retries_async(model, messages, cache, cache_key):
+    scheduler = get_llm_scheduler()
+    for i in range(3):
+        async with scheduler.slot(_messages_tokens(messages)):
+            raw = await request_api_stream_async(model, messages)
+        scheduler.charge(count_tokens(raw))
+        if raw != "Error" and raw.strip():
+            content = clean_deepseek_content(raw)
+            cache.put(cache_key, content)
+            return content, "finished"
+        print(f'************* API Retry ({i+1}) *************')
+        await asyncio.sleep(3)
+    return "Error", "failed"
+
+async def ChatGPT_API_with_finish_reason_async(model, prompt, api_key=None, chat_history=None):
+    messages = chat_history + [{"role": "user", "content": prompt}] if chat_history else [{"role": "user", "content": prompt}]
+    cache = get_llm_cache()
+    cache_key = cache.make_key(model, messages)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached, "finished"
+    return await get_request_coalescer().run(
+        cache_key, lambda: _request_with_retries_async(model, messages, cache, cache_key)
+    )
+
+async def ChatGPT_API_async(model, prompt, api_key=None, chat_history=None):
+    res, _ = await ChatGPT_API_with_finish_reason_async(model, prompt, api_key, chat_history)
+    return res
 
 def get_json_content(content):
     """Helper to extract pure JSON string from markdown code blocks"""
@@ -202,10 +633,86 @@ def extract_json(content):
         logging.error(f"JSON Parsing failed: {e}")
         return UniversalFallback()
 
+# --- Local Title Matching ---
+# Deterministic pre-filter for the "do fuzzy matching, ignore any space inconsistency"
+# title checks. Only clear matches and clear misses are settled locally.
+TITLE_MATCH_MIN_CHARS = 4       # shorter titles ("1", "A") match almost anything
+TITLE_MATCH_NO_THRESHOLD = 0.5  # below this bigram overlap the title is clearly absent
+
+def normalize_for_match(text):
+    """NFKC-folds, lowercases and drops whitespace/punctuation. CJK characters are kept."""
+    text = unicodedata.normalize('NFKC', str(text or '')).lower()
+    return ''.join(ch for ch in text if ch.isalnum())
+
+def _char_bigrams(text):
+    return [text[i:i+2] for i in range(len(text) - 1)] if len(text) > 1 else [text]
+
+def title_match_score(title, page_text):
+    """
+    Returns (score, position) for title against page_text after normalization.
+    score is the share of the title's character bigrams found in the page (1.0 for a
+    contiguous match); position is the offset of the contiguous match or -1.
+    """
+    norm_title = normalize_for_match(title)
+    norm_page = normalize_for_match(page_text)
+    if not norm_title or not norm_page:
+        return 0.0, -1
+    position = norm_page.find(norm_title)
+    if position != -1:
+        return 1.0, position
+    page_bigrams = set(_char_bigrams(norm_page))
+    title_bigrams = _char_bigrams(norm_title)
+    hits = sum(1 for bigram in title_bigrams if bigram in page_bigrams)
+    return hits / len(title_bigrams), -1
+
+def local_title_check(title, page_text, at_start=False):
+    """
+    Returns 'yes' or 'no' when the local matcher is confident, or None when the
+    LLM has to decide. With at_start the title must open the page.
+    """
+    score, position = title_match_score(title, page_text)
+    if score < TITLE_MATCH_NO_THRESHOLD:
+        return 'no'
+    if len(normalize_for_match(title)) < TITLE_MATCH_MIN_CHARS or position == -1:
+        return None
+    if at_start:
+        return 'yes' if position == 0 else None
+    return 'yes'
+
 # --- Helper Functions ---
 
+_CJK_RE = re.compile(r'[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+@functools.lru_cache(maxsize=None)
+def _get_encoder(model=None):
+    """Loads the tiktoken encoder once per model. Returns None when no encoding can be loaded (e.g. offline)."""
+    try:
+        return tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding("cl100k_base")
+    except KeyError:
+        # Non-OpenAI model names (DeepSeek-V3, qwen...) use the cl100k vocabulary as an approximation
+        return _get_encoder(None) if model else None
+    except Exception as e:
+        logging.warning(f"tiktoken encoder unavailable ({e}), falling back to estimated token counts")
+        return None
+
+def _estimate_tokens(text):
+    # Offline fallback: CJK characters are roughly one token each, other text about four characters per token
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
 def count_tokens(text, model=None):
-    return len(text) // 2
+    if not text: return 0
+    encoder = _get_encoder(model)
+    if encoder is None:
+        return _estimate_tokens(text)
+    return len(encoder.encode_ordinary(text))
+
+def count_tokens_batch(texts, model=None):
+    """Token counts for a list of texts in one call (tiktoken encodes the batch in parallel threads)."""
+    encoder = _get_encoder(model)
+    if encoder is None:
+        return [_estimate_tokens(t) if t else 0 for t in texts]
+    return [len(tokens) for tokens in encoder.encode_ordinary_batch([t or "" for t in texts])]
 
 def write_node_id(data, node_id=0):
     if isinstance(data, dict):
@@ -216,42 +723,367 @@ def write_node_id(data, node_id=0):
         for i in range(len(data)): node_id = write_node_id(data[i], node_id)
     return node_id
 
-def get_nodes(structure):
+def iter_nodes(structure):
+    """Yields every node dict of the tree in pre-order, without copying."""
     if isinstance(structure, dict):
-        sn = copy.deepcopy(structure); sn.pop('nodes', None)
-        nodes = [sn]
+        yield structure
         for k in list(structure.keys()):
-            if 'nodes' in k: nodes.extend(get_nodes(structure[k]))
-        return nodes
+            if 'nodes' in k: yield from iter_nodes(structure[k])
     elif isinstance(structure, list):
-        res = []
-        for i in structure: res.extend(get_nodes(i))
-        return res
+        for i in structure: yield from iter_nodes(i)
+
+def get_nodes(structure):
+    """
+    Flat list of the tree's nodes without their 'nodes' children. Each entry is a
+    shallow view: field values such as 'text' are shared with the tree, not copied.
+    """
+    return [{k: v for k, v in node.items() if k != 'nodes'} for node in iter_nodes(structure)]
 
 def get_pdf_name(pdf_path):
     if hasattr(pdf_path, 'name'): return pdf_path.name
     return os.path.basename(pdf_path)
 
+# Run logs are appended as JSON Lines; buffered entries are written out every
+# JSON_LOG_FLUSH_EVERY entries or JSON_LOG_FLUSH_SECONDS, whichever comes first.
+JSON_LOG_FLUSH_EVERY = int(os.getenv("JSON_LOG_FLUSH_EVERY", "50"))
+JSON_LOG_FLUSH_SECONDS = float(os.getenv("JSON_LOG_FLUSH_SECONDS", "2"))
+
+def compact_json_log(jsonl_path, json_path=None):
+    """Rewrites a JSON Lines run log as the indented JSON list earlier versions produced."""
+    json_path = json_path or os.path.splitext(jsonl_path)[0] + ".json"
+    entries = []
+    with open(jsonl_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                entries.append(json.loads(line))
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(entries, f, indent=2, ensure_ascii=False)
+    return json_path
+
 class JsonLogger:
+    """
+    Append-only run log at logs/<name>_<timestamp>.jsonl, one entry per line.
+    Entries are buffered and flushed periodically, on close() and at interpreter
+    exit. compact() also writes logs/<name>_<timestamp>.json in the old list format.
+    """
     def __init__(self, file_path):
         name = get_pdf_name(file_path)
-        self.filename = f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        os.makedirs("./logs", exist_ok=True); self.log_data = []
+        self.basename = f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        self.filename = f"{self.basename}.jsonl"
+        os.makedirs("./logs", exist_ok=True)
+        self.path = os.path.join("logs", self.filename)
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        atexit.register(self.flush)
     def log(self, level, message, **kwargs):
         entry = {'message': str(message), 'level': level, 'timestamp': datetime.now().isoformat()}
-        self.log_data.append(entry)
-        with open(os.path.join("logs", self.filename), "w", encoding="utf-8") as f:
-            json.dump(self.log_data, f, indent=2, ensure_ascii=False)
+        with self._lock:
+            self._buffer.append(entry)
+            due = (len(self._buffer) >= JSON_LOG_FLUSH_EVERY
+                   or time.monotonic() - self._last_flush >= JSON_LOG_FLUSH_SECONDS)
+        if due: self.flush()
+    def flush(self):
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._buffer: return
+            lines = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in self._buffer)
+            self._buffer = []
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+    def close(self):
+        self.flush()
+        atexit.unregister(self.flush)
+    def compact(self):
+        self.flush()
+        if not os.path.exists(self.path): return None
+        return compact_json_log(self.path, os.path.join("logs", f"{self.basename}.json"))
     def info(self, m): self.log("INFO", m)
     def error(self, m): self.log("ERROR", m)
 
-def get_page_tokens(pdf_path, model=None):
-    page_list = []
+class PageStore:
+    """
+    Parsed pages of one document, built once and shared by the whole pipeline.
+    Indexing yields (text, token_count) tuples like the classic page_list; slicing
+    returns a view over the same storage without copying any text. Tagged page
+    text (<physical_index_N> ... <physical_index_N>) is built lazily and memoized,
+    N being the absolute 1-based page number.
+    """
+    def __init__(self, texts, tokens, _tagged=None, _tagged_tokens=None, _start=0, _stop=None):
+        self._texts = texts
+        self._tokens = tokens
+        self._tagged = _tagged if _tagged is not None else [None] * len(texts)
+        self._tagged_tokens = _tagged_tokens if _tagged_tokens is not None else [None] * len(texts)
+        self._start = _start
+        self._stop = len(texts) if _stop is None else _stop
+
+    @classmethod
+    def from_page_list(cls, page_list):
+        if isinstance(page_list, PageStore): return page_list
+        return cls([p[0] for p in page_list], [p[1] for p in page_list])
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            stop = max(start, stop)
+            return PageStore(self._texts, self._tokens, self._tagged, self._tagged_tokens,
+                             self._start + start, self._start + stop)
+        if key < 0: key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError('page index out of range')
+        return (self._texts[self._start + key], self._tokens[self._start + key])
+
+    def __iter__(self):
+        for i in range(self._start, self._stop):
+            yield (self._texts[i], self._tokens[i])
+
+    def page_number(self, i):
+        """Absolute 1-based page number of local index i."""
+        return self._start + i + 1
+
+    def text(self, i):
+        return self._texts[self._start + i]
+
+    def tokens(self, i):
+        return self._tokens[self._start + i]
+
+    def token_sum(self):
+        return sum(self._tokens[self._start:self._stop])
+
+    def tagged(self, i):
+        idx = self._start + i
+        if self._tagged[idx] is None:
+            self._tagged[idx] = f"<physical_index_{idx+1}>\n{self._texts[idx]}\n<physical_index_{idx+1}>\n\n"
+        return self._tagged[idx]
+
+    def tagged_tokens(self, i, model=None):
+        idx = self._start + i
+        if self._tagged_tokens[idx] is None:
+            # Page tokens are already counted, only the tag wrapper is encoded
+            tag = f"<physical_index_{idx+1}>\n\n<physical_index_{idx+1}>\n\n"
+            self._tagged_tokens[idx] = self._tokens[idx] + count_tokens(tag, model)
+        return self._tagged_tokens[idx]
+
+    def to_list(self):
+        return [list(page) for page in self]
+
+def tagged_page_text(page_list, list_index, physical_index):
+    """<physical_index_N> wrapped page text, served from the PageStore cache when numbering agrees."""
+    if isinstance(page_list, PageStore) and page_list.page_number(list_index) == physical_index:
+        return page_list.tagged(list_index)
+    return f"<physical_index_{physical_index}>\n{page_list[list_index][0]}\n<physical_index_{physical_index}>\n\n"
+
+def get_tagged_pages(page_list, start_index=1, model=None):
+    """Returns (tagged page texts, token counts) for page_list numbered from start_index."""
+    page_contents = []
+    token_lengths = []
+    for list_index in range(len(page_list)):
+        page_index = list_index + start_index
+        page_contents.append(tagged_page_text(page_list, list_index, page_index))
+        if isinstance(page_list, PageStore) and page_list.page_number(list_index) == page_index:
+            token_lengths.append(page_list.tagged_tokens(list_index, model))
+        else:
+            token_lengths.append(count_tokens(page_contents[-1], model))
+    return page_contents, token_lengths
+
+# --- PDF Text Extraction ---
+# Large documents are split into page ranges extracted by a process pool; small
+# ones are extracted serially since worker start-up would dominate.
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", "0")) or (os.cpu_count() or 1)
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "64"))
+
+def _extract_page_range(source, start, stop):
+    """Process-pool worker: extracts pages [start, stop) from a PDF path or raw bytes."""
+    reader = PyPDF2.PdfReader(BytesIO(source) if isinstance(source, bytes) else source)
+    return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+def extract_page_texts(pdf_path, workers=None, min_pages=None):
+    workers = workers or PDF_EXTRACT_WORKERS
+    min_pages = PDF_PARALLEL_MIN_PAGES if min_pages is None else min_pages
     reader = PyPDF2.PdfReader(pdf_path)
-    for page in reader.pages:
-        t = page.extract_text() or ""
-        page_list.append((t, len(t)))
-    return page_list
+    num_pages = len(reader.pages)
+    if workers <= 1 or num_pages < min_pages:
+        return [page.extract_text() or "" for page in reader.pages]
+
+    source = pdf_path.getvalue() if isinstance(pdf_path, BytesIO) else pdf_path
+    # Several ranges per worker so an expensive stretch of pages does not idle the rest
+    chunk = max(1, math.ceil(num_pages / (workers * 4)))
+    ranges = [(start, min(start + chunk, num_pages)) for start in range(0, num_pages, chunk)]
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, len(ranges))) as executor:
+            futures = [executor.submit(_extract_page_range, source, start, stop) for start, stop in ranges]
+            texts = []
+            for future in futures:
+                texts.extend(future.result())
+        return texts
+    except Exception as e:
+        logging.warning(f"Parallel PDF extraction failed ({e}), falling back to serial extraction")
+        return [page.extract_text() or "" for page in reader.pages]
+
+def get_page_tokens(pdf_path, model=None, workers=None):
+    texts = extract_page_texts(pdf_path, workers=workers)
+    return PageStore(texts, count_tokens_batch(texts, model))
+
+class StageTimer:
+    """Collects wall-clock time per pipeline stage."""
+    def __init__(self):
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[name] = round(self.timings.get(name, 0) + elapsed, 3)
+            print(f"[INFO] Stage '{name}' took {elapsed:.2f}s")
+
+# --- Stage Checkpoints ---
+# Stage outputs of a run are kept per document so a crashed run resumes from the
+# last completed stage instead of starting over at PDF parsing.
+CHECKPOINT_DIR = os.getenv("PAGEINDEX_CHECKPOINT_DIR", "./checkpoints")
+# Options that change the shape of the tree; a checkpoint made with other values is discarded
+CHECKPOINT_OPTIONS = ('model', 'toc_check_page_num', 'max_page_num_each_node', 'max_token_num_each_node',
+                      'toc_generation_mode', 'if_add_node_id')
+
+def index_options(opt):
+    """The options a stored tree depends on; saved alongside it and compared before reuse."""
+    return {k: getattr(opt, k, None) for k in CHECKPOINT_OPTIONS}
+
+def file_sha256(doc):
+    h = hashlib.sha256()
+    if isinstance(doc, BytesIO):
+        h.update(doc.getvalue())
+    else:
+        with open(doc, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+class Checkpoint:
+    """
+    Checkpoint directory of one document, <CHECKPOINT_DIR>/<pdf name>_<content hash>/.
+    Each stage is one JSON file written atomically; node summaries are appended to
+    summaries.jsonl as they complete, so a crash mid-stage loses only in-flight calls.
+    The directory is removed once the results are saved. A disabled checkpoint
+    (doc=None) loads nothing and saves nothing.
+    """
+    def __init__(self, doc=None, opt=None, root=None):
+        self.enabled = doc is not None
+        self.dir = None
+        if not self.enabled: return
+        name = os.path.splitext(get_pdf_name(doc))[0]
+        self.dir = os.path.join(root or CHECKPOINT_DIR, f"{name}_{file_sha256(doc)[:16]}")
+        os.makedirs(self.dir, exist_ok=True)
+        options = index_options(opt)
+        if self.load('options') != options:
+            self.clear()
+            self.save('options', options)
+
+    def _path(self, stage):
+        return os.path.join(self.dir, f"{stage}.json")
+
+    def load(self, stage):
+        if not self.enabled or not os.path.exists(self._path(stage)): return None
+        try:
+            with open(self._path(stage), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable checkpoint '{stage}': {e}")
+            return None
+
+    def save(self, stage, data):
+        if not self.enabled: return
+        tmp_path = self._path(stage) + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self._path(stage))
+
+    def load_page_list(self):
+        data = self.load('page_list')
+        return PageStore(data['texts'], data['tokens']) if data else None
+
+    def save_page_list(self, page_list):
+        page_list = PageStore.from_page_list(page_list)
+        self.save('page_list', {'texts': [text for text, _ in page_list], 'tokens': [tokens for _, tokens in page_list]})
+
+    def load_summaries(self):
+        summaries = {}
+        if not self.enabled or not os.path.exists(os.path.join(self.dir, "summaries.jsonl")): return summaries
+        with open(os.path.join(self.dir, "summaries.jsonl"), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # last line cut short by the crash
+                summaries[entry['key']] = entry['summary']
+        return summaries
+
+    def save_summary(self, key, summary):
+        if not self.enabled: return
+        with open(os.path.join(self.dir, "summaries.jsonl"), 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'key': key, 'summary': summary}, ensure_ascii=False) + "\n")
+
+    def clear(self):
+        if not self.enabled: return
+        for entry in os.listdir(self.dir):
+            os.remove(os.path.join(self.dir, entry))
+
+    def remove(self):
+        """Deletes the checkpoint once results are saved, so a later run indexes afresh."""
+        if not self.enabled or not os.path.isdir(self.dir): return
+        self.clear()
+        os.rmdir(self.dir)
+        self.enabled = False
+
+# --- Incremental Re-indexing ---
+# Pages are identified by a hash of their whitespace-normalized text; a node's
+# content is identified by the hashes of the pages it spans.
+def page_hash(text):
+    return hashlib.sha256(" ".join((text or "").split()).encode('utf-8')).hexdigest()[:16]
+
+def page_hashes(page_list):
+    return [page_hash(text) for text, _ in page_list]
+
+def page_range_key(hashes, start, end):
+    """Content key of the 1-based inclusive page range, None if it falls outside the document."""
+    if not start or not end or start < 1 or end > len(hashes) or end < start:
+        return None
+    return hashlib.sha256("|".join(hashes[start-1:end]).encode('utf-8')).hexdigest()
+
+def unchanged_page_map(old_hashes, new_hashes):
+    """Maps 1-based old page numbers to new ones for pages that survived unchanged, in order."""
+    matcher = difflib.SequenceMatcher(None, old_hashes, new_hashes, autojunk=False)
+    mapping = {}
+    for old_start, new_start, size in matcher.get_matching_blocks():
+        for k in range(size):
+            mapping[old_start + k + 1] = new_start + k + 1
+    return mapping
+
+def collect_summaries(structure, hashes):
+    """Summaries of a tree keyed by the content of the pages each node spans."""
+    summaries = {}
+    for node in iter_nodes(structure):
+        key = page_range_key(hashes, node.get('start_index'), node.get('end_index'))
+        if key and node.get('summary'):
+            summaries[key] = node['summary']
+    return summaries
+
+def reuse_summaries(structure, hashes, summaries):
+    """Copies earlier summaries onto nodes whose pages are unchanged; returns how many were reused."""
+    reused = 0
+    for node in iter_nodes(structure):
+        key = page_range_key(hashes, node.get('start_index'), node.get('end_index'))
+        if not node.get('summary') and key in summaries:
+            node['summary'] = summaries[key]
+            reused += 1
+    return reused
 
 def list_to_tree(data):
     nodes, roots = {}, []
@@ -355,10 +1187,17 @@ def convert_physical_index_to_int(data):
     return data
 
 def get_text_of_pages(pdf_path, start, end, tag=True):
-    reader = PyPDF2.PdfReader(pdf_path)
+    # Accepts a PageStore (or page_list) to avoid re-opening and re-parsing the PDF
+    if isinstance(pdf_path, (PageStore, list)):
+        pages = pdf_path
+        page_text = lambda i: pages[i][0]
+    else:
+        reader = PyPDF2.PdfReader(pdf_path)
+        pages = reader.pages
+        page_text = lambda i: reader.pages[i].extract_text() or ""
     text = ""
     # Add bounds checking
-    total_pages = len(reader.pages)
+    total_pages = len(pages)
     start = max(1, start)
     
     # range is exclusive at the end, so min(end, total_pages) might miss the last page if end==total_pages
@@ -368,7 +1207,7 @@ def get_text_of_pages(pdf_path, start, end, tag=True):
     loop_end = min(end, total_pages)
     
     for i in range(start-1, loop_end):
-        t = reader.pages[i].extract_text() or ""
+        t = page_text(i)
         text += f"<start_index_{i+1}>\n{t}\n<end_index_{i+1}>\n" if tag else t
     return text
 
@@ -423,66 +1262,80 @@ def convert_page_to_int(toc_list):
             
     return toc_list
 
+def page_range_text(page_list, start, end, limit=None):
+    """
+    Text of 1-based pages start..end (inclusive), one page per line block as stored
+    in node['text']. page_list entries are (text, tokens) pairs or plain strings.
+    With limit, stops once that many characters are collected.
+    """
+    parts, size = [], 0
+    for i in range(max(0, start - 1), min(len(page_list), end)):
+        page = page_list[i]
+        text = page if isinstance(page, str) else page[0]
+        parts.append(text + "\n")
+        size += len(text) + 1
+        if limit and size >= limit: break
+    text = "".join(parts)
+    return text[:limit] if limit else text
+
+def node_text(node, page_list, limit=None):
+    """
+    A node's text: the inline 'text' field if present, otherwise materialized on
+    demand from the shared page table through the node's start_index/end_index.
+    """
+    if node.get('text') is not None:
+        return node['text'][:limit] if limit else node['text']
+    start = int(node.get('start_index') or 1)
+    end = int(node.get('end_index') or start)
+    return page_range_text(page_list, start, end, limit)
+
 def add_node_text(structure, page_list):
     """
     Populates the tree nodes with actual text from the PDF page_list
     based on start_index and end_index.
     """
-    if isinstance(structure, list):
-        for node in structure:
-            add_node_text(node, page_list)
-            
-    elif isinstance(structure, dict):
-        # Default to 0 if indices are missing or None
-        start = int(structure.get('start_index') or 1)
-        end = int(structure.get('end_index') or start)
-        
-        text_content = ""
-        # PDF pages are 1-based, page_list is 0-based
-        max_page = len(page_list)
-        
-        start_idx = max(0, start - 1)
-        end_idx = min(max_page, end) # Loop until 'end' (exclusive in slicing if we used slicing)
-        
-        # Logic: if start=1, end=2. We want page 0 and page 1.
-        # range(0, 2) gives 0, 1. Correct.
-        
-        for i in range(start_idx, end_idx):
-            if i < len(page_list):
-                # page_list[i] is a tuple (text, length)
-                text_content += page_list[i][0] + "\n"
-                
-        structure['text'] = text_content
-        
-        # Recursively process children
-        if 'nodes' in structure:
-            add_node_text(structure['nodes'], page_list)
+    for node in iter_nodes(structure):
+        # Default to page 1 if indices are missing or None
+        start = int(node.get('start_index') or 1)
+        end = int(node.get('end_index') or start)
+        node['text'] = page_range_text(page_list, start, end)
 
-async def generate_summaries_for_structure(structure, model=None):
+async def generate_summaries_for_structure(structure, model=None, checkpoint=None, page_list=None):
     """
     Generates summaries for every node in the tree structure using the LLM.
+    With a checkpoint, summaries of an interrupted run are reused and every new
+    summary is recorded as soon as it arrives. Nodes without inline text read it
+    from page_list.
     """
-    # Get all nodes flattened
-    nodes = get_nodes(structure)
+    # Walk the real nodes: summaries written to copies would be lost
+    nodes = list(iter_nodes(structure))
+    done = checkpoint.load_summaries() if checkpoint else {}
     tasks = []
     
     # Define the async worker for a single node
-    async def summarize_node(node):
-        text_content = node.get('text', '')
+    async def summarize_node(key, node):
+        # Limit text to avoid token overflow, simple prompt
+        text_content = node_text(node, page_list, limit=4000) if page_list is not None else node.get('text', '')[:4000]
         if not text_content: 
             node['summary'] = ""
             return
 
-        # Limit text to avoid token overflow, simple prompt
-        prompt = f"Summarize the following section text in one concise sentence:\n\n{text_content[:4000]}"
+        prompt = f"Summarize the following section text in one concise sentence:\n\n{text_content}"
         
         # Call the async API wrapper
         summary = await ChatGPT_API_async(model, prompt)
         node['summary'] = summary.strip()
+        if checkpoint: checkpoint.save_summary(key, node['summary'])
 
     # Create tasks for all nodes
-    for node in nodes:
-        tasks.append(summarize_node(node))
+    for i, node in enumerate(nodes):
+        key = f"{i}:{node.get('title', '')}"
+        if key in done:
+            node['summary'] = done[key]
+            continue
+        if node.get('summary'):
+            continue  # carried over from an earlier index of this document
+        tasks.append(summarize_node(key, node))
         
     # Run all summary generations in parallel
     if tasks:
@@ -526,4 +1379,34 @@ def remove_structure_text(structure):
             remove_structure_text(structure['nodes'])
     elif isinstance(structure, list):
         for item in structure:
-            remove_structure_text(item)
\ No newline at end of file
+            remove_structure_text(item)
+
+def _write_json(value, write, indent, level):
+    if isinstance(value, dict) and value:
+        open_sep = "\n" + " " * (indent * (level + 1)) if indent else ""
+        close_sep = "\n" + " " * (indent * level) if indent else ""
+        key_sep = ": " if indent else ":"
+        write("{")
+        for i, (k, v) in enumerate(value.items()):
+            write(("," if i else "") + open_sep + json.dumps(str(k), ensure_ascii=False) + key_sep)
+            _write_json(v, write, indent, level + 1)
+        write(close_sep + "}")
+    elif isinstance(value, (list, tuple)) and value:
+        open_sep = "\n" + " " * (indent * (level + 1)) if indent else ""
+        close_sep = "\n" + " " * (indent * level) if indent else ""
+        write("[")
+        for i, item in enumerate(value):
+            write(("," if i else "") + open_sep)
+            _write_json(item, write, indent, level + 1)
+        write(close_sep + "]")
+    else:
+        # Scalars, including whole page texts, go through the C encoder in one call
+        write(json.dumps(value, ensure_ascii=False))
+
+def write_json_stream(data, fp, compact=False, indent=2):
+    """
+    Serializes a results tree to fp piece by piece instead of building the whole
+    document as one string. The default output matches json.dump(..., indent=2,
+    ensure_ascii=False); compact=True writes it on one line without whitespace.
+    """
+    _write_json(data, fp.write, None if compact else indent, 0)
@@ -5,15 +5,18 @@ import sys
 import json
 import os
 import html
+import traceback
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QLabel, QLineEdit, QPushButton, QTextEdit, QListWidget,
-    QListWidgetItem, QFileDialog, QSplitter, QMessageBox,
+    QLabel, QLineEdit, QPushButton, QTextEdit, QListView,
+    QFileDialog, QSplitter, QMessageBox, QProgressBar,
     QComboBox, QShortcut, QSlider
 )
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QThread, pyqtSignal, QAbstractListModel, QModelIndex
 from PyQt5.QtGui import QTextCursor, QTextCharFormat, QColor
 
+from recall_index import RecallIndex
+
 # 兼容不同 PyQt5 版本的 QKeySequence 位置
 try:
     from PyQt5.QtGui import QKeySequence
@@ -34,15 +37,176 @@ except ImportError:
     HAS_PANDAS = False
 
 
+# 召回结果列表最多显示的条数（按相关度排序）
+RECALL_TOP_K = 200
+
+
+class RecallCorpus:
+    """
+    已加载索引文件的节点库：扁平节点、所属文件、page_ref 页表和 BM25F 倒排索引。
+    不依赖界面，由 IndexLoaderThread 在后台线程中构建，构建完成后整体交给窗口。
+    """
+    def __init__(self):
+        self.paths = []
+        self.nodes = []              # 扁平化存储所有已加载文件的节点
+        self.node_files = []         # 每个节点所属的文件名
+        self.node_pages = {}         # id(node) -> 所属 page_ref 文件的共享页表
+        self.index = RecallIndex()
+
+    @classmethod
+    def load(cls, file_paths, progress=None):
+        """progress(done, total, message) 用于汇报进度"""
+        corpus = cls()
+        corpus.paths = list(file_paths)
+        for i, file_path in enumerate(file_paths):
+            if progress:
+                progress(i, len(file_paths), f"读取 {os.path.basename(file_path)}")
+            nodes, pages = corpus._read_index_file(file_path)
+            corpus.nodes.extend(nodes)
+            corpus.node_files.extend([os.path.basename(file_path)] * len(nodes))
+            if pages:
+                corpus.node_pages.update((id(node), pages) for node in nodes)
+
+        total = len(corpus.nodes)
+        on_built = (lambda done: progress(done, total, "构建索引")) if progress else None
+        corpus.index = RecallIndex.build(
+            (corpus.searchable_fields(node) for node in corpus.nodes), progress=on_built
+        )
+        if progress:
+            progress(total, total, "构建索引")
+        return corpus
+
+    def _read_index_file(self, file_path):
+        """读取单个索引文件，返回 (扁平节点列表, page_ref 页表或 None)"""
+        with open(file_path, 'r', encoding='utf-8-sig') as f:
+            data = json.load(f)
+        # page_ref 格式：正文按页只存一份，节点按页码区间引用
+        pages = data.get('pages') if isinstance(data, dict) else None
+        nodes = []
+        self._flatten_structure(self._smart_parse_structure(data), nodes)
+        return nodes, pages
+
+    def _smart_parse_structure(self, data):
+        if isinstance(data, list):
+            return data
+        elif isinstance(data, dict):
+            if 'structure' in data and isinstance(data['structure'], list):
+                return data['structure']
+            if 'nodes' in data and isinstance(data['nodes'], list):
+                return data['nodes']
+            return [data]
+        return []
+
+    def _flatten_structure(self, nodes, out):
+        if not nodes:
+            return
+        for item in nodes:
+            if isinstance(item, dict):
+                out.append(item)
+                if 'nodes' in item and isinstance(item['nodes'], list):
+                    self._flatten_structure(item['nodes'], out)
+
+    def title(self, position):
+        node = self.nodes[position]
+        # 兼容两种格式的标题提取
+        return node.get('title') or node.get('metadata', {}).get('section_path', '（无标题）')
+
+    def node_text(self, node):
+        """节点正文：优先取内联 text，否则按 start_index/end_index 从所属文件的页表中拼出"""
+        pages = self.node_pages.get(id(node))
+        if node.get('text') is not None or not pages:
+            return node.get('text', '')
+        try:
+            start = int(node.get('start_index') or 1)
+            end = int(node.get('end_index') or start)
+        except (TypeError, ValueError):
+            return ''
+        return ''.join(page + '\n' for page in pages[max(0, start - 1):end])
+
+    def searchable_fields(self, node):
+        # 兼容两种格式，按 BM25F 的 title / summary / text 三个字段组织
+        section_path = str(node.get('metadata', {}).get('section_path', ''))
+        if 'original_content' in node:  # RAG格式：text 是摘要，original_content 是正文
+            return {
+                'title': ' '.join([str(node.get('title', '')), section_path]),
+                'summary': str(node.get('text', '')),
+                'text': str(node.get('original_content', ''))
+            }
+        return {
+            'title': ' '.join([str(node.get('title', '')), section_path]),
+            'summary': str(node.get('summary', '')),
+            'text': self.node_text(node)
+        }
+
+
+class IndexLoaderThread(QThread):
+    """后台读取索引文件并构建倒排索引，避免大文件卡住界面"""
+    progress = pyqtSignal(int, int, str)   # 已完成, 总数, 当前阶段
+    loaded = pyqtSignal(object)            # 构建好的 RecallCorpus
+    failed = pyqtSignal(str)               # 错误信息（含堆栈）
+
+    def __init__(self, file_paths, parent=None):
+        super().__init__(parent)
+        self.file_paths = list(file_paths)
+
+    def run(self):
+        try:
+            corpus = RecallCorpus.load(self.file_paths, progress=self.progress.emit)
+            self.loaded.emit(corpus)
+        except Exception as e:
+            self.failed.emit(f"{str(e)}\n\n{traceback.format_exc()}")
+
+
+class NodeListModel(QAbstractListModel):
+    """
+    召回结果列表模型：每行只保存节点在 RecallCorpus 中的位置（和相关度），
+    标题、提示等在视图绘制可见行时才按位置读取，节点详情点击时再取。
+    """
+    PositionRole = Qt.UserRole
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.corpus = RecallCorpus()
+        self.rows = []
+        self.scores = None
+
+    def set_rows(self, corpus, rows, scores=None):
+        self.beginResetModel()
+        self.corpus = corpus
+        self.rows = rows
+        self.scores = scores
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.rows):
+            return None
+        position = self.rows[index.row()]
+        if role == Qt.DisplayRole:
+            title = self.corpus.title(position)
+            return (title[:50] + '...') if len(title) > 50 else title
+        if role == Qt.ToolTipRole:
+            tooltip = f"{self.corpus.title(position)}\n📁 {self.corpus.node_files[position]}"
+            if self.scores is not None:
+                tooltip += f"\n📈 相关度: {self.scores[index.row()]:.2f}"
+            return tooltip
+        if role == self.PositionRole:
+            return position
+        return None
+
+
 class PGIRecallWindow(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("PageIndex - 知识召回查询中心 (DeepSeek适配版)")
         self.resize(1400, 900)
 
-        self.data = None
-        self.all_nodes = []          # 扁平化存储所有节点
-        self.last_loaded_path = None # 记录最后加载的文件路径，用于刷新
+        self.corpus = RecallCorpus() # 已加载文件的节点与倒排索引，后台线程构建
+        self.all_nodes = []          # 扁平化存储所有已加载文件的节点（即 corpus.nodes）
+        self.loaded_paths = []       # 记录已加载的文件路径，用于刷新
+        self.loader = None           # 正在运行的 IndexLoaderThread
 
         self.init_ui()
         self.apply_styles()
@@ -62,6 +226,7 @@ class PGIRecallWindow(QMainWindow):
         top_bar = QHBoxLayout()
 
         self.btn_load = QPushButton("📂 加载索引JSON")
+        self.btn_load.setToolTip("可多选，多个文件合并为一个召回库")
         self.btn_load.clicked.connect(self.load_json)
 
         self.btn_refresh = QPushButton("🔄 刷新")
@@ -102,8 +267,15 @@ class PGIRecallWindow(QMainWindow):
         left_layout = QVBoxLayout(left_widget)
         left_layout.setContentsMargins(0, 0, 0, 0)
         left_layout.addWidget(QLabel("召回结果列表:"))
-        self.list_results = QListWidget()
-        self.list_results.itemClicked.connect(self.display_node_detail)
+        self.progress_load = QProgressBar()
+        self.progress_load.setVisible(False)
+        left_layout.addWidget(self.progress_load)
+        # 虚拟化列表：模型只存行号，视图只绘制可见行
+        self.model_results = NodeListModel(self)
+        self.list_results = QListView()
+        self.list_results.setUniformItemSizes(True)
+        self.list_results.setModel(self.model_results)
+        self.list_results.clicked.connect(self.display_node_detail)
         left_layout.addWidget(self.list_results)
 
         # 右侧：详情预览 + 正文检索
@@ -207,15 +379,15 @@ class PGIRecallWindow(QMainWindow):
                 padding: 6px;
                 border-radius: 6px;
             }
-            QListWidget { 
+            QListView { 
                 background-color: #0d1117; 
                 border: 1px solid #30363d; 
                 border-radius: 6px;
                 color: #c9d1d9; 
                 padding: 5px;
             }
-            QListWidget::item { padding: 8px; }
-            QListWidget::item:selected { 
+            QListView::item { padding: 8px; }
+            QListView::item:selected { 
                 background-color: #1f6feb; 
                 border-radius: 6px; 
                 color: white; 
@@ -230,6 +402,14 @@ class PGIRecallWindow(QMainWindow):
                 font-family: Consolas, 'Microsoft YaHei';
             }
             QSplitter::handle { background-color: #30363d; width: 6px; }
+            QProgressBar {
+                background-color: #161b22;
+                border: 1px solid #30363d;
+                border-radius: 6px;
+                color: #c9d1d9;
+                text-align: center;
+            }
+            QProgressBar::chunk { background-color: #238636; border-radius: 6px; }
             QSlider::groove:horizontal {
                 border: 1px solid #30363d;
                 height: 6px;
@@ -252,7 +432,7 @@ class PGIRecallWindow(QMainWindow):
         self.lbl_font_val.setText(f"{size}px")
         
         base_style_list = f"""
-            QListWidget {{
+            QListView {{
                 background-color: #0d1117; 
                 border: 1px solid #30363d; 
                 border-radius: 6px;
@@ -298,126 +478,119 @@ class PGIRecallWindow(QMainWindow):
             self.edit_inner_search.selectAll()
 
     def load_json(self):
-        file_path, _ = QFileDialog.getOpenFileName(
-            self, "选择索引文件", "", "JSON Files (*.json);;All Files (*)"
+        file_paths, _ = QFileDialog.getOpenFileNames(
+            self, "选择索引文件（可多选）", "", "JSON Files (*.json);;All Files (*)"
         )
-        if file_path:
-            self._load_file(file_path)
+        if file_paths:
+            self._load_files(file_paths)
 
     def refresh_current_file(self):
-        if self.last_loaded_path and os.path.exists(self.last_loaded_path):
+        paths = [p for p in self.loaded_paths if os.path.exists(p)]
+        if paths:
             self.edit_search.clear()
-            self._load_file(self.last_loaded_path)
+            self._load_files(paths)
         else:
             QMessageBox.information(self, "提示", "尚未加载任何文件，或文件已不存在，无法刷新。")
 
     def _load_file(self, file_path):
-        try:
-            with open(file_path, 'r', encoding='utf-8-sig') as f:
-                self.data = json.load(f)
-
-            self.all_nodes = []
-            root_nodes = self._smart_parse_structure(self.data)
-            self._flatten_structure(root_nodes)
-
-            if not self.all_nodes:
-                self.txt_detail.setPlainText(
-                    f"⚠️ 文件加载成功，但未解析到任何知识节点。\n"
-                    f"文件: {os.path.basename(file_path)}\n"
-                    f"请检查 JSON 是否包含 'structure' 或节点列表。"
-                )
-                self.list_results.clear()
-                self.txt_header.clear()
-                return
-
-            self.last_loaded_path = file_path
-            self.list_results.clear()
-            for node in self.all_nodes:
-                self._add_item_to_list(node)
+        self._load_files([file_path])
 
+    def _load_files(self, file_paths):
+        if self.loader is not None and self.loader.isRunning():
+            QMessageBox.information(self, "提示", "正在后台加载索引文件，请稍候。")
+            return
+        self.btn_load.setEnabled(False)
+        self.btn_refresh.setEnabled(False)
+        self.progress_load.setRange(0, 0)
+        self.progress_load.setVisible(True)
+        self.txt_detail.setPlainText(f"⏳ 正在后台加载 {len(file_paths)} 个索引文件，界面可继续操作...")
+
+        self.loader = IndexLoaderThread(file_paths, self)
+        self.loader.progress.connect(self._on_load_progress)
+        self.loader.loaded.connect(self._on_files_loaded)
+        self.loader.failed.connect(self._on_load_failed)
+        self.loader.finished.connect(self._on_loader_finished)
+        self.loader.start()
+
+    def _on_load_progress(self, done, total, stage):
+        self.progress_load.setRange(0, max(total, 1))
+        self.progress_load.setValue(done)
+        self.progress_load.setFormat(f"{stage} {done}/{total}")
+
+    def _on_loader_finished(self):
+        self.progress_load.setVisible(False)
+        self.btn_load.setEnabled(True)
+        self.btn_refresh.setEnabled(True)
+
+    def _on_load_failed(self, error):
+        self.txt_detail.setPlainText(f"❌ 加载失败: {error}")
+        QMessageBox.critical(self, "错误", f"无法加载文件:\n{error.splitlines()[0] if error else ''}")
+
+    def _on_files_loaded(self, corpus):
+        file_names = '、'.join(os.path.basename(p) for p in corpus.paths)
+        # 与列表保持一致：空文件也替换掉上一次加载的节点，刷新路径仍保留上一次成功的
+        self.corpus = corpus
+        self.all_nodes = corpus.nodes
+        if not corpus.nodes:
             self.txt_detail.setPlainText(
-                f"✅ 已成功加载索引文件\n"
-                f"📄 文件: {os.path.basename(file_path)}\n"
-                f"📊 共解析出 {len(self.all_nodes)} 个知识节点\n\n"
-                f"请使用上方搜索框进行关键词召回，或点击左侧查看详情。"
+                f"⚠️ 文件加载成功，但未解析到任何知识节点。\n"
+                f"文件: {file_names}\n"
+                f"请检查 JSON 是否包含 'structure' 或节点列表。"
             )
+            self.model_results.set_rows(corpus, [])
             self.txt_header.clear()
-            self.edit_inner_search.clear()
+            return
 
-        except Exception as e:
-            import traceback
-            error_msg = f"❌ 加载失败: {str(e)}\n\n{traceback.format_exc()}"
-            self.txt_detail.setPlainText(error_msg)
-            QMessageBox.critical(self, "错误", f"无法加载文件:\n{str(e)}")
+        self.loaded_paths = corpus.paths
+        self.model_results.set_rows(corpus, range(len(corpus.nodes)))
 
-    def _smart_parse_structure(self, data):
-        if isinstance(data, list):
-            return data
-        elif isinstance(data, dict):
-            if 'structure' in data and isinstance(data['structure'], list):
-                return data['structure']
-            if 'nodes' in data and isinstance(data['nodes'], list):
-                return data['nodes']
-            return [data]
-        return []
+        self.txt_detail.setPlainText(
+            f"✅ 已成功加载 {len(corpus.paths)} 个索引文件\n"
+            f"📄 文件: {file_names}\n"
+            f"📊 共解析出 {len(corpus.nodes)} 个知识节点\n\n"
+            f"请使用上方搜索框进行关键词召回，或点击左侧查看详情。"
+        )
+        self.txt_header.clear()
+        self.edit_inner_search.clear()
 
-    def _flatten_structure(self, nodes):
-        if not nodes:
-            return
-        for item in nodes:
-            if isinstance(item, dict):
-                self.all_nodes.append(item)
-                if 'nodes' in item and isinstance(item['nodes'], list):
-                    self._flatten_structure(item['nodes'])
+    def _node_text(self, node):
+        return self.corpus.node_text(node)
+
+    def closeEvent(self, event):
+        # 等待后台加载线程结束，避免线程仍在运行时被销毁
+        if self.loader is not None and self.loader.isRunning():
+            self.loader.wait()
+        super().closeEvent(event)
 
     def search_content(self):
         query = self.edit_search.text().strip().lower()
-        self.list_results.clear()
 
         if not query:
-            for node in self.all_nodes:
-                self._add_item_to_list(node)
+            self.model_results.set_rows(self.corpus, range(len(self.all_nodes)))
             self.txt_detail.setPlainText(f"显示全部 {len(self.all_nodes)} 个节点。")
             return
 
-        results = 0
-        for node in self.all_nodes:
-            # 兼容两种格式的可搜索字段
-            searchable = ' '.join([
-                str(node.get('title', '')),
-                str(node.get('metadata', {}).get('section_path', '')),
-                str(node.get('text', '')),
-                str(node.get('summary', '')),
-                str(node.get('original_content', ''))
-            ]).lower()
-
-            if query in searchable:
-                self._add_item_to_list(node)
-                results += 1
+        # 倒排索引求交后按 BM25F 打分，只列出得分最高的前 RECALL_TOP_K 个
+        results, top = self.corpus.index.rank_top(query, k=RECALL_TOP_K)
+        self.model_results.set_rows(self.corpus, [i for i, _ in top], [score for _, score in top])
 
         if results > 0:
+            shown = f"（按相关度显示前 {RECALL_TOP_K} 个）" if results > RECALL_TOP_K else "（按相关度排序）"
             self.txt_detail.setPlainText(
                 f"🔍 查询: \"{query}\"\n"
-                f"✅ 找到 {results} 个匹配节点\n"
+                f"✅ 找到 {results} 个匹配节点{shown}\n"
                 f"请点击左侧列表查看详细内容。"
             )
         else:
             self.txt_detail.setPlainText(f"⚠️ 未找到包含 \"{query}\" 的内容。")
 
-    def _add_item_to_list(self, node):
-        # 兼容两种格式的标题提取
-        title = node.get('title') or node.get('metadata', {}).get('section_path', '（无标题）')
-        display = (title[:50] + '...') if len(title) > 50 else title
-        item = QListWidgetItem(display)
-        item.setToolTip(title)
-        item.setData(Qt.UserRole, node)
-        self.list_results.addItem(item)
-
-    def display_node_detail(self, item):
-        if item is None:
+    def display_node_detail(self, index):
+        if index is None or not index.isValid():
             return
 
-        node = item.data(Qt.UserRole)
+        # 行内只存节点位置，点击时才从 corpus 取出节点详情
+        position = index.data(NodeListModel.PositionRole)
+        node = self.all_nodes[position] if position is not None and position < len(self.all_nodes) else None
         if not node or not isinstance(node, dict):
             self.txt_header.clear()
             self.txt_detail.setPlainText("<i style='color:#8b949e;'>(无效节点数据)</i>")
@@ -433,11 +606,11 @@ class PGIRecallWindow(QMainWindow):
 
         # 兼容两种格式的摘要和正文
         if 'original_content' in node:  # RAG格式
-            summary = node.get('text', '')
+            summary = self._node_text(node)
             raw_text = node.get('original_content', '')
         else:  # 标准格式
             summary = node.get('summary', '')
-            raw_text = node.get('text', '')
+            raw_text = self._node_text(node)
 
         header_html = f"""
         <h2 style='color: #58a6ff; margin: 0 0 10px 0;'>{html.escape(title)}</h2>
@@ -551,12 +724,12 @@ class PGIRecallWindow(QMainWindow):
             doc.add_heading(title, level=1)
             doc.add_paragraph(f"页码: {node.get('start_index', '-')} - {node.get('end_index', '-')}")
             doc.add_paragraph(f"Node ID: {node.get('node_id', 'N/A')}")
-            summary = node.get('summary') or node.get('text', '')
+            summary = node.get('summary') or self._node_text(node)
             if summary:
                 p = doc.add_paragraph()
                 p.add_run("AI 摘要: ").bold = True
                 p.add_run(summary)
-            raw_text = node.get('text', '') if 'original_content' not in node else node.get('original_content', '')
+            raw_text = self._node_text(node) if 'original_content' not in node else node.get('original_content', '')
             doc.add_paragraph(raw_text or '(无正文)')
             doc.add_paragraph("-" * 40)
         doc.save(path)
@@ -569,10 +742,10 @@ class PGIRecallWindow(QMainWindow):
                 f.write(f"标题: {title}\n")
                 f.write(f"页码: {node.get('start_index', '-')} - {node.get('end_index', '-')}\n")
                 f.write(f"Node ID: {node.get('node_id', 'N/A')}\n")
-                summary = node.get('summary') or node.get('text', '')
+                summary = node.get('summary') or self._node_text(node)
                 if summary:
                     f.write(f"AI 摘要: {summary}\n")
-                raw_text = node.get('text', '') if 'original_content' not in node else node.get('original_content', '')
+                raw_text = self._node_text(node) if 'original_content' not in node else node.get('original_content', '')
                 f.write(f"正文:\n{raw_text or '(无正文)'}\n")
                 f.write("\n" + "-" * 60 + "\n\n")
 
@@ -582,8 +755,8 @@ class PGIRecallWindow(QMainWindow):
         data = []
         for node in self.all_nodes:
             title = node.get('title') or node.get('metadata', {}).get('section_path', '')
-            summary = node.get('summary') or node.get('text', '')
-            raw_text = node.get('text', '') if 'original_content' not in node else node.get('original_content', '')
+            summary = node.get('summary') or self._node_text(node)
+            raw_text = self._node_text(node) if 'original_content' not in node else node.get('original_content', '')
             data.append({
                 "Node ID": node.get('node_id', ''),
                 "标题": title,
@@ -600,8 +773,8 @@ class PGIRecallWindow(QMainWindow):
         data = []
         for node in self.all_nodes:
             title = node.get('title') or node.get('metadata', {}).get('section_path', '')
-            summary = node.get('summary') or node.get('text', '')
-            raw_text = node.get('text', '') if 'original_content' not in node else node.get('original_content', '')
+            summary = node.get('summary') or self._node_text(node)
+            raw_text = self._node_text(node) if 'original_content' not in node else node.get('original_content', '')
             data.append({
                 "Node ID": node.get('node_id', ''),
                 "标题": title,
@@ -62,6 +62,14 @@ def recursive_walk(nodes, path=[], depth=1):
         if "nodes" in node and isinstance(node["nodes"], list):
             yield from recursive_walk(node["nodes"], current_path, depth + 1)
 
+def node_text(node, pages):
+    # page_ref 格式的节点没有 text 字段，按 start_index/end_index 从共享页表中拼出正文
+    if node.get("text") is not None or not pages:
+        return node.get("text", node.get("content", ""))
+    start = int(node.get("start_index") or 1)
+    end = int(node.get("end_index") or start)
+    return "".join(page + "\n" for page in pages[max(0, start - 1):end])
+
 def call_llm_api(prompt, model_name):
     headers = {
         "Authorization": f"Bearer {API_KEY}",
@@ -144,6 +152,7 @@ def main():
             data = json.load(f)
         
         root_nodes = []
+        pages = None
         doc_title = "Unknown Document"
         
         if isinstance(data, list):
@@ -151,6 +160,7 @@ def main():
         elif isinstance(data, dict):
             root_nodes = data.get("structure", [])
             doc_title = data.get("doc_name", data.get("title", "Unknown Document"))
+            pages = data.get("pages")
         
         output_data = []
         processed_count = 0
@@ -161,7 +171,7 @@ def main():
             node = item["node"]
             path = item["path"]
             depth = item["depth"]
-            content = node.get("text", node.get("content", ""))
+            content = node_text(node, pages)
 
             # 过滤逻辑：只处理 1、2 级标题，且内容长度大于 50
             if depth not in (1, 2):
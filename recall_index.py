@@ -0,0 +1,161 @@
+import re
+import math
+import heapq
+import bisect
+import operator
+import unicodedata
+from collections import Counter
+
+# CJK ideographs, kana and Hangul are indexed as character bigrams (plus single
+# characters for one-character queries); everything else as lowercase words.
+CJK_CHARS = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+TOKEN_RE = re.compile(f"([{CJK_CHARS}]+)|([^\\W_{CJK_CHARS}]+)")
+
+# BM25F: per-field boost and length normalization, one saturation k1 over the
+# boosted sum (Robertson/Zaragoza). Titles are short, so length matters less there.
+FIELDS = ('title', 'summary', 'text')
+FIELD_WEIGHTS = {'title': 3.0, 'summary': 2.0, 'text': 1.0}
+FIELD_B = {'title': 0.3, 'summary': 0.5, 'text': 0.75}
+BM25_K1 = 1.2
+
+
+def normalize(text):
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+def tokenize(text):
+    """Index terms of text: lowercase words, single CJK characters and CJK character bigrams."""
+    terms = []
+    for cjk, word in TOKEN_RE.findall(normalize(text)):
+        if word:
+            terms.append(word)
+        else:
+            terms.extend(cjk)
+            terms.extend(map(operator.add, cjk, cjk[1:]))
+    return terms
+
+
+class RecallIndex:
+    """
+    Inverted index over the loaded nodes, built once per load. Each posting maps a
+    node position to the term's BM25F pseudo-frequency in that node (field
+    frequencies boosted and length-normalized at build time), so ranking a query
+    is a few dictionary lookups per matching node.
+
+    A query matches the nodes that contain every query term: CJK terms exactly,
+    words as prefixes, so a partly typed word already finds its hits.
+    """
+    def __init__(self):
+        self.postings = {}
+        self.idf = {}
+        self.terms = []
+        self.size = 0
+
+    @classmethod
+    def build(cls, documents, field_weights=None, field_b=None, progress=None, progress_every=500):
+        """
+        documents: iterable of {field: text} dicts (plain strings count as 'text'),
+        one per node. progress, if given, is called with the number of documents
+        tokenized so far every progress_every documents.
+        """
+        field_weights = field_weights or FIELD_WEIGHTS
+        field_b = field_b or FIELD_B
+        index = cls()
+        raw = {}
+        lengths = {field: [] for field in FIELDS}
+        for doc_id, doc in enumerate(documents):
+            if isinstance(doc, str):
+                doc = {'text': doc}
+            for field in FIELDS:
+                terms = tokenize(doc.get(field) or "")
+                lengths[field].append(len(terms))
+                for term, tf in Counter(terms).items():
+                    raw.setdefault(term, []).append((doc_id, field, tf))
+            index.size = doc_id + 1
+            if progress and index.size % progress_every == 0:
+                progress(index.size)
+
+        avg = {field: (sum(lengths[field]) / index.size if index.size else 0) or 1 for field in FIELDS}
+        for term, entries in raw.items():
+            weights = {}
+            for doc_id, field, tf in entries:
+                b = field_b[field]
+                norm = 1 - b + b * lengths[field][doc_id] / avg[field]
+                weights[doc_id] = weights.get(doc_id, 0.0) + field_weights[field] * tf / norm
+            index.postings[term] = weights
+            index.idf[term] = math.log(1 + (index.size - len(weights) + 0.5) / (len(weights) + 0.5))
+        index.terms = sorted(index.postings)
+        return index
+
+    def _expand(self, word):
+        # Every indexed term that starts with word
+        lo = bisect.bisect_left(self.terms, word)
+        hi = bisect.bisect_left(self.terms, word + "\U0010ffff")
+        return self.terms[lo:hi]
+
+    def query_terms(self, query):
+        """(term, is_word) pairs of a query; CJK runs only use bigrams unless one character long."""
+        terms = []
+        for cjk, word in TOKEN_RE.findall(normalize(query)):
+            if word:
+                terms.append((word, True))
+            elif len(cjk) == 1:
+                terms.append((cjk, False))
+            else:
+                terms.extend((cjk[i:i + 2], False) for i in range(len(cjk) - 1))
+        return terms
+
+    def _match(self, query):
+        """(matching node positions, index terms to score them with)."""
+        terms = self.query_terms(query)
+        if not terms:
+            return set(), []
+        # Exact terms first, rarest first, so the running intersection shrinks fast
+        exact = sorted({t for t, is_word in terms if not is_word}, key=lambda t: len(self.postings.get(t, ())))
+        scored = list(exact)
+        result = None
+        for term in exact:
+            docs = self.postings.get(term)
+            if not docs:
+                return set(), []
+            result = set(docs) if result is None else result.intersection(docs)
+            if not result:
+                return set(), []
+        for word in {t for t, is_word in terms if is_word}:
+            expansions = self._expand(word)
+            docs = set()
+            for term in expansions:
+                docs.update(self.postings[term])
+            result = docs if result is None else result & docs
+            if not result:
+                return set(), []
+            scored.extend(expansions)
+        return result, scored
+
+    def search(self, query):
+        """Sorted positions of the nodes matching every term of query."""
+        return sorted(self._match(query)[0])
+
+    def rank(self, query, k=None):
+        """
+        (position, score) of the nodes matching every term of query, best BM25F
+        score first; ties keep tree order. Only the top k are returned when given.
+        """
+        return self.rank_top(query, k)[1]
+
+    def rank_top(self, query, k=None):
+        """(number of matching nodes, rank(query, k)), matching the query only once."""
+        matched, terms = self._match(query)
+        scores = dict.fromkeys(matched, 0.0)
+        for term in set(terms):
+            postings, idf = self.postings[term], self.idf[term]
+            if len(postings) <= len(scores):
+                pairs = ((doc, w) for doc, w in postings.items() if doc in scores)
+            else:
+                pairs = ((doc, postings[doc]) for doc in scores if doc in postings)
+            for doc, w in pairs:
+                scores[doc] += idf * w * (BM25_K1 + 1) / (w + BM25_K1)
+        key = lambda item: (item[1], -item[0])
+        if k is not None and k < len(scores):
+            return len(scores), heapq.nlargest(k, scores.items(), key=key)
+        return len(scores), sorted(scores.items(), key=key, reverse=True)
@@ -1,14 +1,13 @@
 import argparse
 import os
 import sys
-import json
 import asyncio
 
 # Ensure the script can find the 'pageindex' package in the current directory
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 # Fix: Import 'config' explicitly from utils so it can be used to create 'opt'
-from pageindex.utils import config, ConfigLoader 
+from pageindex.utils import config, ConfigLoader, write_json_stream
 from pageindex.page_index import page_index_main
 
 def main():
@@ -17,6 +16,8 @@ def main():
     parser.add_argument('--pdf_path', type=str, required=True, help="Path to the PDF file")
     parser.add_argument('--model', type=str, default="DeepSeek-V3", help="AI Model to use")
     parser.add_argument('--toc-check-pages', type=int, default=3, help="Number of pages to check for TOC")
+    parser.add_argument('--node-store', type=str, default=None, help="Also write nodes to this SQLite database (FTS5 searchable)")
+    parser.add_argument('--compact', action='store_true', help="Write result JSON without indentation (stdout and results/*_full.json)")
     
     # Parse arguments
     args = parser.parse_args()
@@ -30,10 +31,15 @@ def main():
         # Set default values for other options expected by the processor
         max_page_num_each_node=10,
         max_token_num_each_node=5000,
+        verify_batch_size=20,
+        toc_generation_mode='parallel',
         if_add_node_id='yes',
         if_add_node_text='yes',
         if_add_node_summary='yes',
-        if_add_doc_description='no'
+        if_add_doc_description='no',
+        if_compact_json='yes' if args.compact else 'no',
+        if_write_node_store='yes' if args.node_store else 'no',
+        node_store_path=args.node_store
     )
 
     print(f"[INFO] Starting indexing for: {args.pdf_path}")
@@ -42,8 +48,9 @@ def main():
         # Call the main processing function
         result = page_index_main(doc=args.pdf_path, opt=opt)
         
-        # Output the result as JSON (useful for piping to other tools)
-        print(json.dumps(result, ensure_ascii=False, indent=2))
+        # Output the result as JSON (useful for piping to other tools), streamed node by node
+        write_json_stream(result, sys.stdout, compact=args.compact)
+        sys.stdout.write("\n")
         
     except Exception as e:
         print(f"[ERROR] Failed to process PDF: {str(e)}")